@@ -0,0 +1,27 @@
+import asyncio
+import time
+
+
+class RecordingBot:
+    """Stand-in for `context.bot` that records messages instead of calling Telegram."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.messages = []
+        self.first_sent_at = None
+        self.last_sent_at = None
+
+    async def send_message(self, chat_id, text, reply_markup=None, parse_mode=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        if self.first_sent_at is None:
+            self.first_sent_at = now
+        self.last_sent_at = now
+        self.messages.append((chat_id, text))
+
+    @property
+    def sends_per_second(self):
+        if len(self.messages) < 2:
+            return 0.0
+        return (len(self.messages) - 1) / max(self.last_sent_at - self.first_sent_at, 1e-9)
@@ -0,0 +1,102 @@
+import asyncio
+import random
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+
+class GosPlanStub:
+    """Local imitation of the GosPlan `/fz44/purchases` endpoint.
+
+    Every OKVED code gets `initial_tenders` tenders, and new ones arrive at
+    `arrival_rate` tenders per second per code (or at the rate given for the
+    code in `code_rates`) while the stub is running.
+    Responses honour `okved2`, `pageSize` and `page`, are sorted newest first,
+    take `latency` (± `jitter`) seconds and fail with 500/429 at `error_rate`.
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, arrival_rate: float = 0.0,
+                 initial_tenders: int = 5, error_rate: float = 0.0, seed: int = 1, code_rates=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.arrival_rate = arrival_rate
+        self.code_rates = code_rates or {}
+        self.initial_tenders = initial_tenders
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.requests_by_code = {}
+        self._tenders = {}
+        self._arrived = {}
+        self._started = None
+        self._runner = None
+        self.url = None
+        # Recent dates, so that the poller doesn't take the tenders for expired ones
+        self._epoch = datetime.utcnow().replace(microsecond=0) - timedelta(days=1)
+
+    def _tender(self, code: str, number: int):
+        published_at = self._epoch + timedelta(seconds=number)
+        return {
+            'purchase_number': f"{code.replace('.', '')}{number:08d}",
+            'object_info': f"Закупка {number} по ОКВЭД {code}",
+            'max_price': 1000.0 + number,
+            'currency_code': 'RUB',
+            'published_at': published_at.isoformat(),
+            'updated_at': published_at.isoformat(),
+            'collecting_finished_at': (published_at + timedelta(days=10)).isoformat(),
+            'customers': ['7701000000'],
+        }
+
+    def add_tenders(self, code: str, count: int):
+        """Publish `count` new tenders for a code right away."""
+        tenders = self._tenders.setdefault(code, [])
+        start = len(tenders)
+        tenders.extend(self._tender(code, number) for number in range(start, start + count))
+
+    def _catch_up_arrivals(self, code: str):
+        if code not in self._tenders:
+            self.add_tenders(code, self.initial_tenders)
+            self._arrived[code] = 0
+        rate = self.code_rates.get(code, self.arrival_rate)
+        if rate:
+            due = int((asyncio.get_running_loop().time() - self._started) * rate)
+            if due > self._arrived[code]:
+                self.add_tenders(code, due - self._arrived[code])
+                self._arrived[code] = due
+
+    async def handle_purchases(self, request: web.Request):
+        self.requests += 1
+        code = request.query.get('okved2', '')
+        self.requests_by_code[code] = self.requests_by_code.get(code, 0) + 1
+        delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        await asyncio.sleep(delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=self.random.choice([429, 500, 503]))
+
+        page_size = int(request.query.get('pageSize', 20))
+        page = int(request.query.get('page', 1))
+        self._catch_up_arrivals(code)
+        tenders = self._tenders[code]
+        # Newest first, like sortBy=UPDATE_DATE&sortDirection=DESC
+        end = len(tenders) - (page - 1) * page_size
+        start = max(0, end - page_size)
+        return web.json_response(list(reversed(tenders[start:end])) if end > 0 else [])
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        app = web.Application()
+        app.router.add_get('/fz44/purchases', self.handle_purchases)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}/fz44"
+        self._started = asyncio.get_running_loop().time()
+        return self.url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
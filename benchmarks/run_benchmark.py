@@ -0,0 +1,211 @@
+"""Load test of the poll cycle and the send queue against local stubs.
+
+Seeds a throwaway SQLite database with N users subscribed to OKVED codes,
+points the poller at a local GosPlan stub and delivers through a recording
+fake bot, then reports cycle time, API requests, DB queries per cycle,
+sends per second and peak RSS.
+
+    python benchmarks/run_benchmark.py --users 1000 --codes 200 --codes-per-user 5 --cycles 5
+"""
+import argparse
+import asyncio
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    'small': dict(users=100, codes=20, codes_per_user=3),
+    'medium': dict(users=1000, codes=200, codes_per_user=5),
+    'large': dict(users=10000, codes=1000, codes_per_user=5),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the tender pipeline against local stubs")
+    parser.add_argument('--scenario', choices=SCENARIOS, default='small')
+    parser.add_argument('--users', type=int, help="Subscribed users (overrides the scenario)")
+    parser.add_argument('--codes', type=int, help="Distinct OKVED codes (overrides the scenario)")
+    parser.add_argument('--codes-per-user', type=int, help="Subscriptions per user (overrides the scenario)")
+    parser.add_argument('--cycles', type=int, default=3, help="Poll cycles to run")
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help="Seconds between cycle starts; with --adaptive, the first and shortest per-code interval")
+    parser.add_argument('--latency', type=float, default=0.05, help="Stub response latency, seconds")
+    parser.add_argument('--jitter', type=float, default=0.02, help="Stub latency jitter, seconds")
+    parser.add_argument('--initial-tenders', type=int, default=5, help="Tenders per code before the first cycle")
+    parser.add_argument('--arrival-rate', type=float, default=0.5, help="New tenders per code per second")
+    parser.add_argument('--hot-share', type=float, default=0.0,
+                        help="Share of codes that get --hot-rate instead of --arrival-rate")
+    parser.add_argument('--hot-rate', type=float, default=1.0, help="New tenders per second for hot codes")
+    parser.add_argument('--adaptive', type=float, metavar='SECONDS',
+                        help="Run the adaptive per-code scheduler for this long instead of fixed cycles")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of stub responses failing with 429/5xx")
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=20, help="Parallel API requests")
+    parser.add_argument('--api-rate', type=float, default=0, help="API requests per second, 0 for unlimited")
+    parser.add_argument('--send-rate', type=float, default=1000, help="Global send rate, messages per second")
+    parser.add_argument('--send-workers', type=int, default=8)
+    parser.add_argument('--bot-latency', type=float, default=0.0, help="Fake Telegram latency per message, seconds")
+    parser.add_argument('--digest-share', type=float, default=0.0, help="Share of users in digest mode")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    for key, value in SCENARIOS[args.scenario].items():
+        if getattr(args, key) is None:
+            setattr(args, key, value)
+    return args
+
+
+def make_codes(count: int, rng: random.Random):
+    """Distinct OKVED-like codes of mixed depth, so prefix matching is exercised."""
+    codes = set()
+    while len(codes) < count:
+        section = f"{rng.randint(1, 99):02d}"
+        depth = rng.choice((0, 1, 2, 2, 3))
+        if depth == 0:
+            codes.add(section)
+        elif depth == 1:
+            codes.add(f"{section}.{rng.randint(1, 9)}")
+        elif depth == 2:
+            codes.add(f"{section}.{rng.randint(10, 99)}")
+        else:
+            codes.add(f"{section}.{rng.randint(10, 99)}.{rng.randint(1, 9)}")
+    return sorted(codes)
+
+
+def seed_database(args, rng: random.Random):
+    from models import Session, User, Subscription
+
+    codes = make_codes(args.codes, rng)
+    session = Session()
+    try:
+        for number in range(args.users):
+            user = User(telegram_id=10 ** 9 + number, digest_mode=rng.random() < args.digest_share)
+            user.subscriptions = [
+                Subscription(code=code)
+                for code in rng.sample(codes, min(args.codes_per_user, len(codes)))
+            ]
+            session.add(user)
+        session.commit()
+    finally:
+        session.close()
+    return codes
+
+
+async def run(args):
+    from sqlalchemy import event
+
+    import poller
+    from fake_bot import RecordingBot
+    from gosplan_stub import GosPlanStub
+    from models import engine, run_migrations
+    from sender import NotificationSender
+
+    rng = random.Random(args.seed)
+    run_migrations()
+    codes = seed_database(args, rng)
+    hot_codes = set(rng.sample(codes, int(len(codes) * args.hot_share)))
+
+    queries = [0]
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        queries[0] += 1
+
+    stub = GosPlanStub(
+        latency=args.latency,
+        jitter=args.jitter,
+        arrival_rate=args.arrival_rate,
+        initial_tenders=args.initial_tenders,
+        error_rate=args.error_rate,
+        seed=args.seed,
+        code_rates={code: args.hot_rate for code in hot_codes}
+    )
+    poller.GOSPLAN_API_URL = await stub.start()
+    poller.GOSPLAN_PAGE_SIZE = args.page_size
+    poller.GOSPLAN_CONCURRENCY = args.concurrency
+    poller.GOSPLAN_RATE_LIMIT = args.api_rate
+
+    bot = RecordingBot(latency=args.bot_latency)
+    sender = NotificationSender(
+        bot,
+        workers=args.send_workers,
+        global_rate=args.send_rate,
+        per_chat_rate=args.send_rate
+    )
+    state = {}
+    await poller.init_poller_state(state)
+    await sender.start()
+
+    rows = []
+    try:
+        loop = asyncio.get_running_loop()
+        if args.adaptive:
+            # CHECK_INTERVAL (60 s by default) would spread the first polls past a short run
+            poller.CHECK_INTERVAL = args.interval
+            poller.POLL_MIN_INTERVAL = min(poller.POLL_MIN_INTERVAL, args.interval)
+            delivered = [0]
+
+            def deliver(messages, paced=False):
+                delivered[0] += len(messages)
+                sender.submit(messages, paced=paced)
+
+            started = loop.time()
+            requests_before, queries_before = stub.requests, queries[0]
+            task = asyncio.create_task(poller.run_scheduled_polls(state, deliver=deliver))
+            await asyncio.sleep(args.adaptive)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            rows.append((
+                'all', loop.time() - started, stub.requests - requests_before, queries[0] - queries_before, delivered[0]
+            ))
+            # Scheduled polls leave digests to the periodic digest flush
+            await sender.enqueue_unsent(digest_only=True)
+        for cycle in range(1, 0 if args.adaptive else args.cycles + 1):
+            started = loop.time()
+            requests_before, queries_before = stub.requests, queries[0]
+            messages = await poller.run_poll_cycle(state)
+            elapsed = loop.time() - started
+            sender.submit(messages)
+            rows.append((cycle, elapsed, stub.requests - requests_before, queries[0] - queries_before, len(messages)))
+            await asyncio.sleep(max(0.0, args.interval - elapsed))
+
+        drain_started = time.monotonic()
+        await sender.drain()
+        drain_time = time.monotonic() - drain_started
+    finally:
+        await sender.stop()
+        await poller.close_poller_state(state)
+        await stub.stop()
+
+    print(f"Scenario: {args.users} users, {args.codes} codes, {args.codes_per_user} codes per user, "
+          f"latency {args.latency}s, arrivals {args.arrival_rate}/s per code, errors {args.error_rate:.0%}")
+    print(f"{'cycle':>5} {'time, s':>9} {'requests':>9} {'db queries':>11} {'messages':>9}")
+    for cycle, elapsed, requests, cycle_queries, messages in rows:
+        print(f"{cycle:>5} {elapsed:>9.3f} {requests:>9} {cycle_queries:>11} {messages:>9}")
+    print(f"API requests: {stub.requests} ({stub.errors} injected errors)")
+    if hot_codes:
+        hot_requests = sum(stub.requests_by_code.get(code, 0) for code in hot_codes)
+        print(f"Requests per hot code: {hot_requests / len(hot_codes):.1f}, per other code: "
+              f"{(stub.requests - hot_requests) / max(len(codes) - len(hot_codes), 1):.1f}")
+    print(f"Messages sent: {len(bot.messages)}, {bot.sends_per_second:.1f} sends/s, queue drained in {drain_time:.2f}s")
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"Peak RSS: {max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024):.1f} MB")
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        # The models read DATABASE_URL on import, so it is set before any project import
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+        asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
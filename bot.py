@@ -1,32 +1,48 @@
 import os
 import logging
 import asyncio
-from datetime import datetime, timedelta
+import argparse
 import pytz  # Добавляем поддержку часовых поясов
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes, ConversationHandler
-import aiohttp
-import json
-from models import Session, User, Notification
+from models import engine, run_migrations, run_db
+from metrics import METRICS_HOST, METRICS_PORT, SEND_QUEUE_DEPTH, start_metrics_server, track_db_queries
+from okved_index import is_valid_okved
+from subscription_filters import parse_keywords, parse_price_range, parse_regions
+from sender import NotificationSender
+from maintenance import MAINTENANCE_INTERVAL, NOTIFICATION_RETENTION_DAYS, run_maintenance
+from updates import ALLOWED_UPDATES, BOT_CONCURRENT_UPDATES, BOT_MODE, PerChatUpdateProcessor, run_webhook
+from poller import (
+    CHECK_INTERVAL, DIGEST_WINDOW, POLL_MIN_INTERVAL, POLL_MAX_INTERVAL, parse_shard,
+    init_poller_state, close_poller_state, run_scheduled_polls, run_poller
+)
+import repository
 
 # Load environment variables
 load_dotenv()
 
 # Configure logging
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG
+    level=LOG_LEVEL
 )
 logger = logging.getLogger(__name__)
 
-# Add logging for telegram
-logging.getLogger('telegram').setLevel(logging.DEBUG)
-logging.getLogger('httpx').setLevel(logging.DEBUG)
+# Add logging for telegram; httpx logs every long-polling request at INFO
+logging.getLogger('telegram').setLevel(LOG_LEVEL)
+logging.getLogger('httpx').setLevel(logging.WARNING)
 
 # Constants from environment variables
-GOSPLAN_API_URL = os.getenv('GOSPLAN_API_URL', 'https://v2test.gosplan.info/fz44')
-CHECK_INTERVAL = int(os.getenv('CHECK_INTERVAL', 60))
+DB_BATCH_SIZE = int(os.getenv('DB_BATCH_SIZE', 500))  # Rows written per transaction
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', 4))  # Parallel Telegram send tasks
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 30))  # Messages per second across all chats
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))  # Messages per second to a single chat
+SEND_MAX_ATTEMPTS = int(os.getenv('SEND_MAX_ATTEMPTS', 5))
+CATCHUP_SEND_RATE = float(os.getenv('CATCHUP_SEND_RATE', 5))  # Messages per second for notifications backfilled after downtime
+SEND_PICKUP_INTERVAL = int(os.getenv('SEND_PICKUP_INTERVAL', 5))  # Seconds between checks for notifications stored by pollers
+SEND_PICKUP_RESCAN = float(os.getenv('SEND_PICKUP_RESCAN', 60))  # Seconds a stored notification is re-checked by pickups before they skip past it
 TIMEZONE = pytz.timezone('Europe/Moscow')  # Добавляем константу для часового пояса
 
 def format_datetime(dt):
@@ -37,7 +53,7 @@ def format_datetime(dt):
     return local_dt.strftime('%d.%m.%Y %H:%M')
 
 # Conversation states
-MAIN_MENU, WAITING_FOR_OKVED, REMOVE_OKVED_MENU = range(3)
+MAIN_MENU, WAITING_FOR_OKVED, REMOVE_OKVED_MENU, FILTER_MENU, WAITING_FOR_FILTER_VALUE = range(5)
 
 # Callback data
 ADD_OKVED = 'add_okved'
@@ -46,25 +62,105 @@ CHECK_STATUS = 'check_status'
 BACK_TO_MENU = 'back_to_menu'
 ADD_MORE_OKVED = 'add_more_okved'
 FINISH_ADDING = 'finish_adding'
-
-async def get_or_create_user(telegram_id: int, session: Session) -> User:
-    """Get existing user or create new one."""
-    user = session.query(User).filter_by(telegram_id=telegram_id).first()
-    if not user:
-        user = User(telegram_id=telegram_id)
-        session.add(user)
-        session.commit()
-    return user
+TOGGLE_DIGEST = 'toggle_digest'
+FILTERS = 'filters'
+FILTER_RESET = 'filter_reset'
+
+# Subscription columns behind each editable filter setting
+FILTER_COLUMNS = {
+    'include': ('include_keywords',),
+    'exclude': ('exclude_keywords',),
+    'price': ('min_price', 'max_price'),
+    'regions': ('regions',),
+    'days': ('min_days_left',),
+}
+
+# Filter settings that can be edited, with the prompt asking for a value
+FILTER_PROMPTS = {
+    'include': (
+        "Введите ключевые слова через запятую. Закупка подойдёт, если в её названии есть хотя бы одно из них.\n"
+        "Например: ремонт, кровля\n\n"
+        "Отправьте «-», чтобы убрать фильтр."
+    ),
+    'exclude': (
+        "Введите слова-исключения через запятую. Закупки, в названии которых есть любое из них, присылаться не будут.\n"
+        "Например: аренда, питание\n\n"
+        "Отправьте «-», чтобы убрать фильтр."
+    ),
+    'price': (
+        "Введите диапазон начальной цены в рублях.\n"
+        "Например: 100000-5000000, от 100000 или до 5000000\n\n"
+        "Отправьте «-», чтобы убрать фильтр."
+    ),
+    'regions': (
+        "Введите коды регионов заказчика через запятую.\n"
+        "Например: 77, 50 (Москва и Московская область)\n\n"
+        "Отправьте «-», чтобы убрать фильтр."
+    ),
+    'days': (
+        "Введите, сколько дней минимум должно оставаться до окончания приёма заявок.\n"
+        "Например: 3\n\n"
+        "Отправьте «-», чтобы убрать фильтр."
+    ),
+}
 
 def get_main_keyboard():
     """Create main menu keyboard."""
     keyboard = [
         [InlineKeyboardButton("📝 Добавить код ОКВЭД", callback_data=ADD_OKVED)],
         [InlineKeyboardButton("❌ Удалить код ОКВЭД", callback_data=REMOVE_OKVED)],
-        [InlineKeyboardButton("📊 Текущие настройки", callback_data=CHECK_STATUS)]
+        [InlineKeyboardButton("📊 Текущие настройки", callback_data=CHECK_STATUS)],
+        [InlineKeyboardButton("🎯 Фильтры", callback_data=FILTERS)],
+        [InlineKeyboardButton("🗞 Режим дайджеста", callback_data=TOGGLE_DIGEST)]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+def get_filter_codes_keyboard(okved_codes):
+    """Create keyboard for choosing the OKVED code whose filters to edit."""
+    keyboard = [[InlineKeyboardButton(f"🎯 {code}", callback_data=f"flt_{code}")] for code in okved_codes]
+    keyboard.append([InlineKeyboardButton("🔙 Назад в меню", callback_data=BACK_TO_MENU)])
+    return InlineKeyboardMarkup(keyboard)
+
+def get_filter_keyboard():
+    """Create keyboard for editing the filters of one OKVED code."""
+    keyboard = [
+        [InlineKeyboardButton("🔑 Ключевые слова", callback_data="fedit_include")],
+        [InlineKeyboardButton("🚫 Слова-исключения", callback_data="fedit_exclude")],
+        [InlineKeyboardButton("💰 Цена", callback_data="fedit_price")],
+        [InlineKeyboardButton("📍 Регион", callback_data="fedit_regions")],
+        [InlineKeyboardButton("⏳ Срок подачи заявок", callback_data="fedit_days")],
+        [InlineKeyboardButton("🧹 Сбросить фильтры", callback_data=FILTER_RESET)],
+        [InlineKeyboardButton("🔙 К списку кодов", callback_data=FILTERS)],
+        [InlineKeyboardButton("🔙 Назад в меню", callback_data=BACK_TO_MENU)]
     ]
     return InlineKeyboardMarkup(keyboard)
 
+def format_price(value):
+    """Format a price like 1 500 000."""
+    return f"{value:,.0f}".replace(',', ' ')
+
+def format_filter(code, values):
+    """Describe the filters of a subscription for the filter screen."""
+    min_price, max_price = values['min_price'], values['max_price']
+    if min_price is not None and max_price is not None:
+        price = f"от {format_price(min_price)} до {format_price(max_price)} ₽"
+    elif min_price is not None:
+        price = f"от {format_price(min_price)} ₽"
+    elif max_price is not None:
+        price = f"до {format_price(max_price)} ₽"
+    else:
+        price = "любая"
+    days = f"не меньше {values['min_days_left']} дн." if values['min_days_left'] else "любой"
+    return (
+        f"🎯 Фильтры для кода ОКВЭД {code}:\n\n"
+        f"🔑 Ключевые слова: {values['include_keywords'] or 'любые'}\n"
+        f"🚫 Слова-исключения: {values['exclude_keywords'] or 'нет'}\n"
+        f"💰 Цена: {price}\n"
+        f"📍 Регионы: {values['regions'] or 'все'}\n"
+        f"⏳ Срок подачи заявок: {days}\n\n"
+        "Выберите, что изменить:"
+    )
+
 def get_okved_action_keyboard():
     """Create keyboard for OKVED actions."""
     keyboard = [
@@ -76,10 +172,8 @@ def get_okved_action_keyboard():
 def get_remove_okved_keyboard(okved_codes):
     """Create keyboard for removing OKVED codes."""
     keyboard = []
-    if okved_codes:
-        codes = okved_codes.split(',')
-        for code in codes:
-            keyboard.append([InlineKeyboardButton(f"❌ {code.strip()}", callback_data=f"del_{code.strip()}")])
+    for code in okved_codes:
+        keyboard.append([InlineKeyboardButton(f"❌ {code}", callback_data=f"del_{code}")])
     keyboard.append([InlineKeyboardButton("🔙 Назад в меню", callback_data=BACK_TO_MENU)])
     return InlineKeyboardMarkup(keyboard)
 
@@ -90,55 +184,85 @@ def get_start_keyboard():
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Send a message with main menu when the command /start is issued."""
-    session = Session()
-    try:
-        user = await get_or_create_user(update.effective_user.id, session)
-        welcome_message = (
-            "👋 Добро пожаловать в бот мониторинга госзакупок!\n\n"
-            "Я помогу вам отслеживать интересующие вас закупки по кодам ОКВЭД.\n\n"
-            "Выберите действие:"
-        )
-        await update.message.reply_text(welcome_message, reply_markup=get_start_keyboard())
-        await update.message.reply_text("Основное меню:", reply_markup=get_main_keyboard())
-        return MAIN_MENU
-    finally:
-        session.close()
+    await run_db(repository.ensure_user, update.effective_user.id)
+    welcome_message = (
+        "👋 Добро пожаловать в бот мониторинга госзакупок!\n\n"
+        "Я помогу вам отслеживать интересующие вас закупки по кодам ОКВЭД.\n\n"
+        "Выберите действие:"
+    )
+    await update.message.reply_text(welcome_message, reply_markup=get_start_keyboard())
+    await update.message.reply_text("Основное меню:", reply_markup=get_main_keyboard())
+    return MAIN_MENU
 
 async def handle_okved_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle OKVED code input."""
     okved_code = update.message.text.strip()
     
     # Basic validation of OKVED format
-    if not okved_code.replace('.', '').isdigit():
+    if not is_valid_okved(okved_code):
         await update.message.reply_text(
-            "❌ Неверный формат кода ОКВЭД. Используйте формат XX.XX",
+            "❌ Неверный формат кода ОКВЭД. Используйте формат XX.XX или XX для всего раздела",
             reply_markup=InlineKeyboardMarkup([[
                 InlineKeyboardButton("🔙 Назад в меню", callback_data=BACK_TO_MENU)
             ]])
         )
         return WAITING_FOR_OKVED
 
-    session = Session()
+    existing_codes = await run_db(repository.add_subscription, update.effective_user.id, okved_code)
+    codes_list = '\n'.join([f"- {code}" for code in existing_codes])
+    await update.message.reply_text(
+        f"✅ Код ОКВЭД {okved_code} успешно добавлен!\n\nВаши текущие коды:\n{codes_list}",
+        reply_markup=get_okved_action_keyboard()
+    )
+    return WAITING_FOR_OKVED
+
+def parse_filter_value(field, text):
+    """Turn user input for a filter setting into Subscription column values. Raises ValueError."""
+    if text.lower() in ('-', '—', 'нет'):
+        return {column: None for column in FILTER_COLUMNS[field]}
+    if field in ('include', 'exclude'):
+        keywords = parse_keywords(text)
+        if not keywords:
+            raise ValueError("No keywords")
+        return {f'{field}_keywords': ', '.join(keywords)}
+    if field == 'price':
+        min_price, max_price = parse_price_range(text)
+        return {'min_price': min_price, 'max_price': max_price}
+    if field == 'regions':
+        return {'regions': ','.join(parse_regions(text))}
+    days = int(text)
+    if not 0 < days <= 365:
+        raise ValueError(f"Days out of range: {days}")
+    return {'min_days_left': days}
+
+async def handle_filter_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle a new value for the filter setting being edited."""
+    code = context.user_data.get('filter_code')
+    field = context.user_data.get('filter_field')
+    if not code or field not in FILTER_PROMPTS:
+        await update.message.reply_text("Выберите действие:", reply_markup=get_main_keyboard())
+        return MAIN_MENU
+
     try:
-        user = await get_or_create_user(update.effective_user.id, session)
-        # Get existing codes
-        existing_codes = set(user.okved_codes.split(',')) if user.okved_codes else set()
-        # Add new code
-        existing_codes.add(okved_code)
-        # Remove empty strings
-        existing_codes.discard('')
-        # Save updated codes
-        user.okved_codes = ','.join(existing_codes)
-        session.commit()
-        
-        codes_list = '\n'.join([f"- {code}" for code in existing_codes])
+        values = parse_filter_value(field, update.message.text.strip())
+    except ValueError:
         await update.message.reply_text(
-            f"✅ Код ОКВЭД {okved_code} успешно добавлен!\n\nВаши текущие коды:\n{codes_list}",
-            reply_markup=get_okved_action_keyboard()
+            "❌ Не удалось разобрать значение.\n\n" + FILTER_PROMPTS[field],
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🔙 Назад", callback_data=f"flt_{code}")
+            ]])
         )
-        return WAITING_FOR_OKVED
-    finally:
-        session.close()
+        return WAITING_FOR_FILTER_VALUE
+
+    updated = await run_db(repository.update_subscription_filter, update.effective_user.id, code, **values)
+    if updated is None:
+        await update.message.reply_text(
+            f"❌ Код ОКВЭД '{code}' не найден в ваших настройках.",
+            reply_markup=get_main_keyboard()
+        )
+        return MAIN_MENU
+    await update.message.reply_text(format_filter(code, updated), reply_markup=get_filter_keyboard())
+    return FILTER_MENU
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text messages."""
@@ -155,7 +279,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if query.data == ADD_OKVED:
         await query.message.edit_text(
             "Пожалуйста, введите код ОКВЭД в формате XX.XX\n"
-            "Например: 62.01",
+            "Например: 62.01 или 62 для всего раздела",
             reply_markup=InlineKeyboardMarkup([[
                 InlineKeyboardButton("🔙 Назад в меню", callback_data=BACK_TO_MENU)
             ]])
@@ -163,58 +287,122 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return WAITING_FOR_OKVED
     
     elif query.data == REMOVE_OKVED:
-        session = Session()
-        try:
-            user = session.query(User).filter_by(telegram_id=update.effective_user.id).first()
-            if user and user.okved_codes:
-                await query.message.edit_text(
-                    "Выберите коды ОКВЭД для удаления:",
-                    reply_markup=get_remove_okved_keyboard(user.okved_codes)
-                )
-                return REMOVE_OKVED_MENU
-            else:
-                await query.message.edit_text(
-                    "❌ У вас не установлены коды ОКВЭД для мониторинга.",
-                    reply_markup=get_main_keyboard()
-                )
-                return MAIN_MENU
-        finally:
-            session.close()
+        codes = await run_db(repository.get_user_codes, update.effective_user.id)
+        if codes:
+            await query.message.edit_text(
+                "Выберите коды ОКВЭД для удаления:",
+                reply_markup=get_remove_okved_keyboard(codes)
+            )
+            return REMOVE_OKVED_MENU
+        else:
+            await query.message.edit_text(
+                "❌ У вас не установлены коды ОКВЭД для мониторинга.",
+                reply_markup=get_main_keyboard()
+            )
+            return MAIN_MENU
     
     elif query.data == CHECK_STATUS:
-        session = Session()
-        try:
-            user = session.query(User).filter_by(telegram_id=update.effective_user.id).first()
-            if user and user.okved_codes:
-                # Get the latest notification
-                latest_notification = session.query(Notification).filter_by(
-                    user_id=user.id
-                ).order_by(Notification.created_at.desc()).first()
-
-                status_text = "📊 Текущие настройки:\n"
-                status_text += "Коды ОКВЭД:\n"
-                status_text += "\n".join([f"- {code}" for code in user.okved_codes.split(',')])
-                
-                if latest_notification:
-                    status_text += f"\n\n🕒 Последняя проверка: {format_datetime(latest_notification.created_at)}"
-                else:
-                    status_text += "\n\n🕒 Проверки еще не выполнялись"
-                
-                status_text += f"\n⏱ Интервал проверки: {CHECK_INTERVAL} секунд"
-                
-                await query.message.edit_text(
-                    status_text,
-                    reply_markup=get_main_keyboard()
-                )
+        status = await run_db(repository.get_user_status, update.effective_user.id)
+        if status and status['codes']:
+            status_text = "📊 Текущие настройки:\n"
+            status_text += "Коды ОКВЭД:\n"
+            status_text += "\n".join([f"- {code}" for code in status['codes']])
+            
+            if status['last_check']:
+                status_text += f"\n\n🕒 Последняя проверка: {format_datetime(status['last_check'])}"
             else:
-                await query.message.edit_text(
-                    "❌ У вас не установлены коды ОКВЭД для мониторинга.",
-                    reply_markup=get_main_keyboard()
-                )
-        finally:
-            session.close()
+                status_text += "\n\n🕒 Проверки еще не выполнялись"
+            
+            status_text += (
+                f"\n⏱ Интервал проверки: от {POLL_MIN_INTERVAL} до {POLL_MAX_INTERVAL} секунд "
+                f"(чаще для кодов с частыми закупками)"
+            )
+            status_text += f"\n🗞 Режим дайджеста: {'включен' if status['digest_mode'] else 'выключен'}"
+            status_text += (
+                f"\n📬 Уведомлений всего: {status['notifications_total']}, "
+                f"доставлено: {status['notifications_sent']}"
+            )
+            if status['last_sent_at']:
+                status_text += f"\n📨 Последняя доставка: {format_datetime(status['last_sent_at'])}"
+            
+            await query.message.edit_text(
+                status_text,
+                reply_markup=get_main_keyboard()
+            )
+        else:
+            await query.message.edit_text(
+                "❌ У вас не установлены коды ОКВЭД для мониторинга.",
+                reply_markup=get_main_keyboard()
+            )
         return MAIN_MENU
     
+    elif query.data == TOGGLE_DIGEST:
+        digest_mode = await run_db(repository.toggle_digest, update.effective_user.id)
+        if digest_mode:
+            text = (
+                "✅ Режим дайджеста включен.\n\n"
+                "Новые закупки будут приходить одним сообщением со списком вместо отдельного сообщения на каждую."
+            )
+        else:
+            text = "✅ Режим дайджеста выключен.\n\nКаждая новая закупка будет приходить отдельным сообщением."
+            # Notifications held for the next digest would otherwise wait for a pickup
+            await context.application.bot_data['sender'].enqueue_unsent(telegram_id=update.effective_user.id)
+        await query.message.edit_text(text, reply_markup=get_main_keyboard())
+        return MAIN_MENU
+
+    elif query.data == FILTERS:
+        codes = await run_db(repository.get_user_codes, update.effective_user.id)
+        if codes:
+            await query.message.edit_text(
+                "Выберите код ОКВЭД, для которого настроить фильтры:",
+                reply_markup=get_filter_codes_keyboard(codes)
+            )
+            return FILTER_MENU
+        await query.message.edit_text(
+            "❌ У вас не установлены коды ОКВЭД для мониторинга.",
+            reply_markup=get_main_keyboard()
+        )
+        return MAIN_MENU
+
+    elif query.data.startswith("flt_"):
+        code = query.data.replace("flt_", "")
+        values = await run_db(repository.get_subscription_filter, update.effective_user.id, code)
+        if values is None:
+            await query.message.edit_text(
+                f"❌ Код ОКВЭД '{code}' не найден в ваших настройках.",
+                reply_markup=get_main_keyboard()
+            )
+            return MAIN_MENU
+        context.user_data['filter_code'] = code
+        await query.message.edit_text(format_filter(code, values), reply_markup=get_filter_keyboard())
+        return FILTER_MENU
+
+    elif query.data.startswith("fedit_"):
+        field = query.data.replace("fedit_", "")
+        if field not in FILTER_PROMPTS or 'filter_code' not in context.user_data:
+            await query.message.edit_text("Выберите действие:", reply_markup=get_main_keyboard())
+            return MAIN_MENU
+        context.user_data['filter_field'] = field
+        await query.message.edit_text(
+            FILTER_PROMPTS[field],
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton("🔙 Назад", callback_data=f"flt_{context.user_data['filter_code']}")
+            ]])
+        )
+        return WAITING_FOR_FILTER_VALUE
+
+    elif query.data == FILTER_RESET:
+        code = context.user_data.get('filter_code')
+        values = await run_db(
+            repository.update_subscription_filter, update.effective_user.id, code,
+            **{field: None for field in repository.FILTER_FIELDS}
+        ) if code else None
+        if values is None:
+            await query.message.edit_text("Выберите действие:", reply_markup=get_main_keyboard())
+            return MAIN_MENU
+        await query.message.edit_text(format_filter(code, values), reply_markup=get_filter_keyboard())
+        return FILTER_MENU
+
     elif query.data == BACK_TO_MENU:
         await query.message.edit_text(
             "Выберите действие:",
@@ -224,37 +412,28 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif query.data.startswith("del_"):
         code_to_remove = query.data.replace("del_", "")
-        session = Session()
-        try:
-            user = session.query(User).filter_by(telegram_id=update.effective_user.id).first()
-            if user and user.okved_codes:
-                codes = user.okved_codes.split(',')
-                if code_to_remove in codes:
-                    codes.remove(code_to_remove)
-                    user.okved_codes = ','.join(codes)
-                    session.commit()
-                    await query.message.edit_text(
-                        f"✅ Код ОКВЭД '{code_to_remove}' удален из мониторинга.",
-                        reply_markup=get_remove_okved_keyboard(user.okved_codes)
-                    )
-                else:
-                    await query.message.edit_text(
-                        f"❌ Код ОКВЭД '{code_to_remove}' не найден в ваших настройках.",
-                        reply_markup=get_remove_okved_keyboard(user.okved_codes)
-                    )
-            else:
-                await query.message.edit_text(
-                    "❌ У вас не установлены коды ОКВЭД для мониторинга.",
-                    reply_markup=get_main_keyboard()
-                )
-        finally:
-            session.close()
+        removed, codes = await run_db(repository.remove_subscription, update.effective_user.id, code_to_remove)
+        if removed:
+            await query.message.edit_text(
+                f"✅ Код ОКВЭД '{code_to_remove}' удален из мониторинга.",
+                reply_markup=get_remove_okved_keyboard(codes)
+            )
+        elif codes:
+            await query.message.edit_text(
+                f"❌ Код ОКВЭД '{code_to_remove}' не найден в ваших настройках.",
+                reply_markup=get_remove_okved_keyboard(codes)
+            )
+        else:
+            await query.message.edit_text(
+                "❌ У вас не установлены коды ОКВЭД для мониторинга.",
+                reply_markup=get_main_keyboard()
+            )
         return REMOVE_OKVED_MENU
 
     elif query.data == ADD_MORE_OKVED:
         await query.message.edit_text(
             "Пожалуйста, введите код ОКВЭД в формате XX.XX\n"
-            "Например: 62.01",
+            "Например: 62.01 или 62 для всего раздела",
             reply_markup=InlineKeyboardMarkup([[
                 InlineKeyboardButton("🔙 Назад в меню", callback_data=BACK_TO_MENU)
             ]])
@@ -268,139 +447,113 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return MAIN_MENU
 
-async def check_tenders(context: ContextTypes.DEFAULT_TYPE):
-    """Periodically check for new tenders."""
-    logger.info(f"Starting tender check at {format_datetime(datetime.utcnow())}")
+async def pickup_notifications(context: ContextTypes.DEFAULT_TYPE):
+    """Queue notifications stored by separate poller processes or postponed after send errors.
+
+    Runs every SEND_PICKUP_INTERVAL seconds, so status collected since the
+    last flush is saved first and the reload sees what has been delivered;
+    the sender also skips ids it has sent but not yet flushed.
+    """
+    sender = context.application.bot_data['sender']
+    await sender.flush()
+    await sender.enqueue_unsent(include_digests=False, new_only=True)
+
+async def flush_digests(context: ContextTypes.DEFAULT_TYPE):
+    """Queue digests collected since the last flush."""
+    await context.application.bot_data['sender'].enqueue_unsent(digest_only=True)
+
+async def maintenance(context: ContextTypes.DEFAULT_TYPE):
+    """Delete expired notifications and compact the database."""
     try:
-        session = Session()
-        try:
-            users = session.query(User).filter(User.okved_codes.isnot(None)).all()
-            logger.info(f"Found {len(users)} users with OKVED codes")
-            
-            if not users:
-                logger.warning("No users with OKVED codes found!")
-                return
-                
-            for user in users:
-                if not user.okved_codes:
-                    logger.warning(f"User {user.telegram_id} has no OKVED codes")
-                    continue
-                    
-                okved_codes = user.okved_codes.split(',')
-                logger.info(f"Checking tenders for user {user.telegram_id} with OKVED codes: {okved_codes}")
-                
-                # Get the latest notification time for this user
-                latest_notification = session.query(Notification).filter_by(
-                    user_id=user.id
-                ).order_by(Notification.created_at.desc()).first()
-
-                latest_check_time = latest_notification.created_at if latest_notification else datetime.min.replace(tzinfo=None)
-                logger.info(f"Latest check time for user {user.telegram_id}: {format_datetime(latest_check_time)}")
-                
-                for okved_code in okved_codes:
-                    try:
-                        async with aiohttp.ClientSession() as http_session:
-                            params = {
-                                'okved2': okved_code.strip(),
-                                'sortBy': 'UPDATE_DATE',
-                                'sortDirection': 'DESC',
-                                'pageSize': 20
-                            }
-                            logger.info(f"Making API request to {GOSPLAN_API_URL}/purchases with params: {params}")
-                            
-                            async with http_session.get(
-                                f"{GOSPLAN_API_URL}/purchases",
-                                params=params,
-                                timeout=30
-                            ) as response:
-                                logger.info(f"API response status: {response.status}")
-                                if response.status == 200:
-                                    try:
-                                        tenders = await response.json()
-                                        logger.info(f"Received {len(tenders)} tenders for OKVED {okved_code}")
-                                        
-                                        if not tenders:
-                                            logger.info(f"No tenders found for OKVED {okved_code}")
-                                            continue
-
-                                        new_tenders_count = 0
-                                        for tender in tenders:
-                                            # Convert tender published_at to datetime
-                                            tender_date = datetime.fromisoformat(tender.get('published_at')).replace(tzinfo=None)
-                                            logger.info(f"Checking tender {tender.get('purchase_number')} published at {tender_date}")
-                                            
-                                            # Check if tender is newer than our last check
-                                            if tender_date > latest_check_time:
-                                                existing_notification = session.query(Notification).filter_by(
-                                                    user_id=user.id,
-                                                    tender_number=tender.get('purchase_number')
-                                                ).first()
-                                                
-                                                if not existing_notification:
-                                                    new_tenders_count += 1
-                                                    notification = Notification(
-                                                        user_id=user.id,
-                                                        tender_number=tender.get('purchase_number'),
-                                                        tender_name=tender.get('object_info', 'Нет описания'),
-                                                        tender_amount=tender.get('max_price', 0),
-                                                        tender_url=f"https://zakupki.gov.ru/epz/order/notice/ea44/view/common-info.html?regNumber={tender.get('purchase_number')}"
-                                                    )
-                                                    session.add(notification)
-                                                    session.commit()
-                                                    
-                                                    message = (
-                                                        f"🔔 Новая закупка!\n\n"
-                                                        f"📋 Номер: {tender.get('purchase_number')}\n"
-                                                        f"📝 Название: {tender.get('object_info', 'Нет описания')}\n"
-                                                        f"💰 Сумма: {tender.get('max_price', 0):,.2f} {tender.get('currency_code', 'RUB')}\n"
-                                                        f"📅 Дата публикации: {datetime.fromisoformat(tender.get('published_at')).strftime('%d.%m.%Y %H:%M')}\n"
-                                                        f"⏰ Прием заявок до: {datetime.fromisoformat(tender.get('collecting_finished_at')).strftime('%d.%m.%Y %H:%M')}\n"
-                                                        f"🏢 Заказчик: {tender.get('customers', ['Не указан'])[0]}\n"
-                                                        f"🔍 ОКВЭД: {okved_code}\n"
-                                                    )
-                                                    
-                                                    keyboard = [[
-                                                        InlineKeyboardButton(
-                                                            "🔍 Подробнее",
-                                                            url=notification.tender_url
-                                                        )
-                                                    ]]
-                                                    
-                                                    try:
-                                                        await context.bot.send_message(
-                                                            chat_id=user.telegram_id,
-                                                            text=message,
-                                                            reply_markup=InlineKeyboardMarkup(keyboard)
-                                                        )
-                                                        notification.is_sent = True
-                                                        notification.sent_at = datetime.utcnow()
-                                                        session.commit()
-                                                        logger.info(f"Successfully sent notification for tender {tender.get('purchase_number')} to user {user.telegram_id}")
-                                                    except Exception as e:
-                                                        logger.error(f"Error sending message to user {user.telegram_id}: {e}")
-                                                else:
-                                                    logger.info(f"Tender {tender.get('purchase_number')} already notified")
-                                            else:
-                                                logger.info(f"Tender {tender.get('purchase_number')} is older than last check time")
-                                        logger.info(f"Found {new_tenders_count} new tenders for user {user.telegram_id} with OKVED {okved_code}")
-                                    except json.JSONDecodeError as e:
-                                        logger.error(f"Error decoding JSON response: {e}")
-                                else:
-                                    logger.error(f"API request failed with status {response.status}")
-                    except aiohttp.ClientError as e:
-                        logger.error(f"HTTP request error: {e}")
-                    except Exception as e:
-                        logger.error(f"Unexpected error while processing OKVED {okved_code}: {e}")
-        finally:
-            session.close()
+        await run_db(run_maintenance)
     except Exception as e:
-        logger.error(f"Error in check_tenders: {e}")
-    logger.info("Tender check completed")
+        logger.error(f"Maintenance failed: {e}")
+
+async def post_init(application: Application):
+    """Create long-lived resources owned by the application."""
+    if application.bot_data['role'] == 'all':
+        await init_poller_state(application.bot_data)
+
+    sender = NotificationSender(
+        application.bot,
+        workers=SEND_WORKERS,
+        global_rate=SEND_GLOBAL_RATE,
+        per_chat_rate=SEND_CHAT_RATE,
+        max_attempts=SEND_MAX_ATTEMPTS,
+        batch_size=DB_BATCH_SIZE,
+        catchup_rate=CATCHUP_SEND_RATE,
+        pickup_rescan=SEND_PICKUP_RESCAN
+    )
+    await sender.start()
+    application.bot_data['sender'] = sender
+    SEND_QUEUE_DEPTH.set_function(lambda: sender.queue_size)
+
+    if application.bot_data['role'] == 'all':
+        # Poll codes on their adaptive schedules; delivery happens in the sender's own workers
+        application.bot_data['poll_task'] = asyncio.create_task(
+            run_scheduled_polls(application.bot_data, deliver=sender.submit)
+        )
+
+    # In webhook mode /metrics is served by the webhook server
+    if METRICS_PORT and application.bot_data['mode'] != 'webhook':
+        application.bot_data['metrics_runner'] = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+
+async def post_shutdown(application: Application):
+    """Release resources created in post_init."""
+    poll_task = application.bot_data.pop('poll_task', None)
+    if poll_task:
+        poll_task.cancel()
+        await asyncio.gather(poll_task, return_exceptions=True)
+    sender = application.bot_data.pop('sender', None)
+    if sender:
+        await sender.stop()
+    await close_poller_state(application.bot_data)
+    metrics_runner = application.bot_data.pop('metrics_runner', None)
+    if metrics_runner:
+        await metrics_runner.cleanup()
+
+def parse_args():
+    """Parse command line options."""
+    parser = argparse.ArgumentParser(description="Telegram-бот мониторинга госзакупок")
+    parser.add_argument(
+        '--role', choices=['all', 'bot', 'poller'], default='all',
+        help="all: бот и опрос API в одном процессе; bot: только обработка сообщений и отправка; "
+             "poller: только опрос API"
+    )
+    parser.add_argument(
+        '--shard', type=parse_shard, default=(0, 1),
+        help="часть кодов ОКВЭД для процесса опроса в формате i/N, например 0/4"
+    )
+    parser.add_argument(
+        '--mode', choices=['polling', 'webhook'], default=BOT_MODE,
+        help="polling: получать обновления через getUpdates; webhook: принимать их встроенным HTTP-сервером"
+    )
+    return parser.parse_args()
 
 def main():
     """Start the bot."""
-    # Initialize application with job queue
-    application = Application.builder().token(os.getenv('TELEGRAM_TOKEN')).build()
+    args = parse_args()
+
+    # Make sure the database schema and data are up to date
+    run_migrations()
+    track_db_queries(engine)
+
+    if args.role == 'poller':
+        asyncio.run(run_poller(args.shard))
+        return
+
+    # Initialize application with job queue; updates of different chats are handled in parallel
+    builder = (
+        Application.builder()
+        .token(os.getenv('TELEGRAM_TOKEN'))
+        .concurrent_updates(PerChatUpdateProcessor(BOT_CONCURRENT_UPDATES))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if args.mode == 'webhook':
+        # Updates arrive through the embedded webhook server instead of getUpdates
+        builder = builder.updater(None)
+    application = builder.build()
 
     # Create conversation handler
     conv_handler = ConversationHandler(
@@ -421,6 +574,15 @@ def main():
             REMOVE_OKVED_MENU: [
                 CallbackQueryHandler(button_handler),
                 MessageHandler(filters.Regex('^(🚀 Старт|🔄 Перезапустить)$'), start)
+            ],
+            FILTER_MENU: [
+                CallbackQueryHandler(button_handler),
+                MessageHandler(filters.Regex('^(🚀 Старт|🔄 Перезапустить)$'), start)
+            ],
+            WAITING_FOR_FILTER_VALUE: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND & ~filters.Regex('^(🚀 Старт|🔄 Перезапустить)$'), handle_filter_input),
+                CallbackQueryHandler(button_handler),
+                MessageHandler(filters.Regex('^(🚀 Старт|🔄 Перезапустить)$'), start)
             ]
         },
         fallbacks=[
@@ -436,12 +598,22 @@ def main():
     # Add error handler
     application.add_error_handler(error_handler)
 
-    # Start the periodic check with job queue
+    # Start the periodic jobs with job queue; polling itself runs on its own schedule (see post_init)
+    application.bot_data['role'] = args.role
+    application.bot_data['mode'] = args.mode
     job_queue = application.job_queue
-    job_queue.run_repeating(check_tenders, interval=CHECK_INTERVAL, first=1)
+    # Picks up notifications stored by poller processes and retries ones postponed after transient errors
+    job_queue.run_repeating(pickup_notifications, interval=SEND_PICKUP_INTERVAL, first=SEND_PICKUP_INTERVAL)
+    digest_interval = DIGEST_WINDOW or CHECK_INTERVAL
+    job_queue.run_repeating(flush_digests, interval=digest_interval, first=digest_interval)
+    if NOTIFICATION_RETENTION_DAYS > 0:
+        job_queue.run_repeating(maintenance, interval=MAINTENANCE_INTERVAL, first=60)
 
     # Start the Bot
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if args.mode == 'webhook':
+        run_webhook(application)
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle errors in the bot."""
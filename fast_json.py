@@ -0,0 +1,110 @@
+import codecs
+import json
+
+# Optional faster decoders; the standard library is used when neither is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# Exceptions raised for malformed JSON by whichever decoder is in use
+DECODE_ERRORS = (ValueError,) if msgspec is None else (ValueError, msgspec.DecodeError)
+
+
+def decoder_name() -> str:
+    """Name of the decoder loads() uses, for logs."""
+    if orjson is not None:
+        return 'orjson'
+    if msgspec is not None:
+        return 'msgspec'
+    return 'json'
+
+
+def loads(data: bytes):
+    """Decode a JSON document with the fastest available decoder."""
+    if orjson is not None:
+        return orjson.loads(data)
+    if msgspec is not None:
+        return msgspec.json.decode(data)
+    return json.loads(data)
+
+
+class JsonArrayStream:
+    """Incremental parser of a top-level JSON array that arrives in chunks.
+
+    feed() returns the array items completed by each chunk, so a caller can
+    work on the first items before the rest of the body has arrived, or
+    stop reading early. Items are decoded with the standard library's
+    raw_decode, which resumes where the previous item ended.
+    """
+
+    def __init__(self):
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._started = False
+        self._finished = False
+        self._need_comma = False
+
+    def feed(self, chunk: bytes):
+        """Add a chunk of the body and return the items it completed."""
+        self._buffer += self._text_decoder.decode(chunk)
+        return self._parse(final=False)
+
+    def close(self):
+        """Check that the body ended with a complete array; returns any last items."""
+        self._buffer += self._text_decoder.decode(b'', final=True)
+        items = self._parse(final=True)
+        if not self._finished:
+            raise ValueError("Truncated JSON array")
+        return items
+
+    def _parse(self, final: bool):
+        items = []
+        buffer = self._buffer
+        pos = 0
+        length = len(buffer)
+        while True:
+            while pos < length and buffer[pos] in ' \t\r\n':
+                pos += 1
+            if pos >= length:
+                break
+            ch = buffer[pos]
+            if self._finished:
+                raise ValueError(f"Unexpected data after JSON array: {ch!r}")
+            if not self._started:
+                if ch != '[':
+                    raise ValueError(f"Expected a JSON array, got {ch!r}")
+                self._started = True
+                pos += 1
+            elif ch == ']':
+                self._finished = True
+                pos += 1
+            elif ch == ',':
+                if not self._need_comma:
+                    raise ValueError("Unexpected ',' in JSON array")
+                self._need_comma = False
+                pos += 1
+            elif self._need_comma:
+                raise ValueError(f"Expected ',' or ']' in JSON array, got {ch!r}")
+            else:
+                try:
+                    item, end = self._json_decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    # The item is not complete yet; wait for the next chunk
+                    break
+                if not final and isinstance(item, (int, float)) and (end >= length or buffer[end] not in ' \t\r\n,]'):
+                    # A number cut by the chunk boundary (e.g. '1.' of '1.5') continues in the next chunk
+                    break
+                items.append(item)
+                self._need_comma = True
+                pos = end
+        self._buffer = buffer[pos:]
+        return items
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import random
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+import fast_json
+
+logger = logging.getLogger(__name__)
+
+# Statuses that are worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Bytes read from the socket at a time when streaming a response
+STREAM_CHUNK_SIZE = 16384
+
+
+class GosPlanError(Exception):
+    """A GosPlan API request failed for good (retries exhausted or a bad response)."""
+
+
+class RateLimiter:
+    """Space out request starts so that at most `rate` requests per second hit a host."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class GosPlanClient:
+    """Long-lived pooled HTTP client for the GosPlan API.
+
+    One keep-alive connection pool with DNS caching is shared by all requests.
+    Requests run concurrently up to `concurrency`, are rate limited per host
+    and retried with exponential backoff and jitter on 429/5xx and timeouts.
+    """
+
+    def __init__(self, base_url: str, concurrency: int = 10, rate_limit: float = 5.0,
+                 max_retries: int = 3, timeout: float = 30, backoff_base: float = 0.5,
+                 backoff_max: float = 30.0):
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.rate_limit = rate_limit
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._session = None
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._limiters = {}
+
+    async def start(self):
+        """Open the shared connection pool."""
+        if self._session is not None:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.concurrency,
+            limit_per_host=self.concurrency,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        logger.info(
+            f"GosPlan client started for {self.base_url} (concurrency={self.concurrency}, "
+            f"rate={self.rate_limit}/s, json={fast_json.decoder_name()})"
+        )
+
+    async def close(self):
+        """Close the connection pool."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+            logger.info("GosPlan client closed")
+
+    def _limiter_for(self, url: str) -> RateLimiter:
+        host = urlsplit(url).netloc
+        if host not in self._limiters:
+            self._limiters[host] = RateLimiter(self.rate_limit)
+        return self._limiters[host]
+
+    def _backoff(self, attempt: int, retry_after=None) -> float:
+        """Exponential backoff with full jitter, honoring Retry-After when given."""
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def get_json(self, path: str, params=None, decode=None):
+        """GET `path` and decode the JSON body. Returns None once retries are exhausted.
+
+        `decode` turns the raw body into the result; by default the fastest
+        available JSON decoder is used.
+        """
+        if self._session is None:
+            await self.start()
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        limiter = self._limiter_for(url)
+
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            async with self._semaphore:
+                await limiter.wait()
+                try:
+                    async with self._session.get(url, params=params) as response:
+                        if response.status == 200:
+                            return (decode or fast_json.loads)(await response.read())
+                        if response.status not in RETRY_STATUSES:
+                            logger.error(f"API request to {url} failed with status {response.status}")
+                            return None
+                        retry_after = response.headers.get('Retry-After')
+                        logger.warning(f"API request to {url} returned {response.status} (attempt {attempt + 1})")
+                except asyncio.TimeoutError:
+                    logger.warning(f"API request to {url} timed out (attempt {attempt + 1})")
+                except aiohttp.ClientError as e:
+                    logger.warning(f"HTTP request error for {url}: {e} (attempt {attempt + 1})")
+                except fast_json.DECODE_ERRORS as e:
+                    logger.error(f"Error decoding JSON response from {url}: {e}")
+                    return None
+
+            if attempt < self.max_retries:
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+
+        logger.error(f"API request to {url} failed after {self.max_retries + 1} attempts")
+        return None
+
+    async def iter_json_array(self, path: str, params=None):
+        """GET `path` and yield the items of the JSON array body as they arrive.
+
+        Retries like get_json until the first item is yielded; after that a
+        broken response can't be retried without repeating items. Raises
+        GosPlanError when the request fails. Closing the generator early
+        (e.g. with contextlib.aclosing) stops reading the body.
+        """
+        if self._session is None:
+            await self.start()
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        limiter = self._limiter_for(url)
+
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            yielded = False
+            async with self._semaphore:
+                await limiter.wait()
+                try:
+                    async with self._session.get(url, params=params) as response:
+                        if response.status == 200:
+                            stream = fast_json.JsonArrayStream()
+                            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                                for item in stream.feed(chunk):
+                                    yielded = True
+                                    yield item
+                            for item in stream.close():
+                                yield item
+                            return
+                        if response.status not in RETRY_STATUSES:
+                            raise GosPlanError(f"API request to {url} failed with status {response.status}")
+                        retry_after = response.headers.get('Retry-After')
+                        logger.warning(f"API request to {url} returned {response.status} (attempt {attempt + 1})")
+                except asyncio.TimeoutError:
+                    if yielded:
+                        raise GosPlanError(f"API response from {url} timed out while streaming") from None
+                    logger.warning(f"API request to {url} timed out (attempt {attempt + 1})")
+                except aiohttp.ClientError as e:
+                    if yielded:
+                        raise GosPlanError(f"API response from {url} broke off while streaming: {e}") from e
+                    logger.warning(f"HTTP request error for {url}: {e} (attempt {attempt + 1})")
+                except ValueError as e:
+                    raise GosPlanError(f"Error decoding JSON response from {url}: {e}") from e
+
+            if attempt < self.max_retries:
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+
+        raise GosPlanError(f"API request to {url} failed after {self.max_retries + 1} attempts")
@@ -1,8 +1,8 @@
-from models import Base, engine
+from models import run_migrations
 
 def init_database():
-    """Initialize the database by creating all tables."""
-    Base.metadata.create_all(engine)
+    """Initialize the database by creating all tables and migrating old data."""
+    run_migrations()
     print("Database initialized successfully!")
 
 if __name__ == "__main__":
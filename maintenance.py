@@ -0,0 +1,163 @@
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+from models import Session, engine, Notification, Tender, UserStats
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATION_RETENTION_DAYS = int(os.getenv('NOTIFICATION_RETENTION_DAYS', 90))  # Delivered notifications kept this long; 0 keeps everything
+MAINTENANCE_INTERVAL = int(os.getenv('MAINTENANCE_INTERVAL', 3600))  # Seconds between maintenance runs
+MAINTENANCE_BATCH_SIZE = int(os.getenv('MAINTENANCE_BATCH_SIZE', 1000))  # Rows deleted per transaction
+MAINTENANCE_TIME_BUDGET = float(os.getenv('MAINTENANCE_TIME_BUDGET', 30))  # Seconds a run may spend deleting; the rest waits for the next run
+VACUUM_PAGES = int(os.getenv('VACUUM_PAGES', 2000))  # Free SQLite pages returned to the OS per run
+
+
+def retention_cutoff():
+    """Notifications created before this moment may be deleted, or None if retention is off.
+
+    The poller ignores tenders published before it (see poller._match_candidates),
+    so deleting their notifications cannot lead to a repeated notification.
+    """
+    if NOTIFICATION_RETENTION_DAYS <= 0:
+        return None
+    return datetime.utcnow() - timedelta(days=NOTIFICATION_RETENTION_DAYS)
+
+
+def _archive_batch(session, rows):
+    """Fold deleted notifications into the per-user rollup."""
+    totals = {}
+    for _, user_id, is_sent, created_at, sent_at, _ in rows:
+        count, sent, last_created, last_sent = totals.get(user_id, (0, 0, None, None))
+        totals[user_id] = (
+            count + 1,
+            sent + bool(is_sent),
+            max(filter(None, (last_created, created_at)), default=None),
+            max(filter(None, (last_sent, sent_at)), default=None)
+        )
+    stats = {
+        row.user_id: row
+        for row in session.query(UserStats).filter(UserStats.user_id.in_(list(totals)))
+    }
+    for user_id, (count, sent, last_created, last_sent) in totals.items():
+        row = stats.get(user_id)
+        if row is None:
+            row = UserStats(user_id=user_id, archived_notifications=0, archived_sent=0)
+            session.add(row)
+        row.archived_notifications += count
+        row.archived_sent += sent
+        row.last_notification_at = max(filter(None, (row.last_notification_at, last_created)), default=None)
+        row.last_sent_at = max(filter(None, (row.last_sent_at, last_sent)), default=None)
+
+
+def prune_notifications(cutoff: datetime, batch_size: int, deadline: float) -> int:
+    """Delete delivered or failed notifications created before `cutoff`, a batch per transaction.
+
+    Pending notifications are kept whatever their age. Returns the number of
+    deleted rows.
+    """
+    deleted = 0
+    after_id = 0
+    reached_cutoff = False
+    while not reached_cutoff and time.monotonic() < deadline:
+        session = Session()
+        try:
+            # Ids grow with created_at: walk them in order and stop at the first row
+            # younger than the cutoff, so only expired rows are ever scanned
+            rows = session.query(
+                Notification.id, Notification.user_id, Notification.is_sent,
+                Notification.created_at, Notification.sent_at, Notification.failed_at
+            ).filter(Notification.id > after_id).order_by(Notification.id).limit(batch_size).all()
+            if not rows:
+                break
+            reached_cutoff = any(row.created_at and row.created_at >= cutoff for row in rows)
+            expired = [
+                row for row in rows
+                if row.created_at and row.created_at < cutoff and (row.is_sent or row.failed_at)
+            ]
+            if expired:
+                _archive_batch(session, expired)
+                session.query(Notification).filter(
+                    Notification.id.in_([row.id for row in expired])
+                ).delete(synchronize_session=False)
+                session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        deleted += len(expired)
+        after_id = rows[-1].id
+    return deleted
+
+
+def prune_tenders(cutoff: datetime, batch_size: int, deadline: float) -> int:
+    """Delete tenders stored before `cutoff` that no notification refers to any more."""
+    deleted = 0
+    after_id = 0
+    reached_cutoff = False
+    while not reached_cutoff and time.monotonic() < deadline:
+        session = Session()
+        try:
+            rows = session.query(Tender.id, Tender.created_at).filter(
+                Tender.id > after_id
+            ).order_by(Tender.id).limit(batch_size).all()
+            if not rows:
+                break
+            reached_cutoff = any(row.created_at and row.created_at >= cutoff for row in rows)
+            ids = [row.id for row in rows if row.created_at and row.created_at < cutoff]
+            after_id = rows[-1].id
+            if not ids:
+                continue
+            referenced = {tender_id for tender_id, in session.query(Notification.tender_id).filter(
+                Notification.tender_id.in_(ids)
+            ).distinct()}
+            orphans = [tender_id for tender_id in ids if tender_id not in referenced]
+            if orphans:
+                session.query(Tender).filter(Tender.id.in_(orphans)).delete(synchronize_session=False)
+                session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        deleted += len(orphans)
+    return deleted
+
+
+def compact_database(vacuum_pages: int):
+    """Return free pages to the OS and refresh planner statistics (SQLite only)."""
+    if engine.dialect.name != 'sqlite':
+        return
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        if vacuum_pages > 0:
+            connection.exec_driver_sql(f'PRAGMA incremental_vacuum({vacuum_pages})')
+        # Runs ANALYZE on the tables whose statistics are out of date
+        connection.exec_driver_sql('PRAGMA optimize')
+
+
+def run_maintenance():
+    """Delete expired notifications and orphaned tenders, then compact the database.
+
+    Blocking; run it in the database thread pool. Returns (deleted
+    notifications, deleted tenders).
+    """
+    cutoff = retention_cutoff()
+    if cutoff is None:
+        return 0, 0
+    started = time.monotonic()
+    deadline = started + MAINTENANCE_TIME_BUDGET
+    notifications = prune_notifications(cutoff, MAINTENANCE_BATCH_SIZE, deadline)
+    tenders = prune_tenders(cutoff, MAINTENANCE_BATCH_SIZE, deadline)
+    compact_database(VACUUM_PAGES)
+    logger.info(
+        f"Maintenance deleted {notifications} notifications and {tenders} tenders "
+        f"older than {cutoff:%Y-%m-%d} in {time.monotonic() - started:.1f}s"
+    )
+    return notifications, tenders
@@ -0,0 +1,99 @@
+import os
+import logging
+
+from aiohttp import web
+from dotenv import load_dotenv
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))  # Port of the /metrics endpoint, one per process on a host; 0 disables it
+
+# Default histogram buckets in seconds, from fast DB calls to slow poll cycles
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Buckets for delays measured in minutes to hours, e.g. publication to notification
+DELAY_BUCKETS = (10, 30, 60, 120, 300, 600, 1800, 3600, 7200, 21600, 86400)
+
+
+# Poll pipeline
+POLL_CYCLE_SECONDS = Histogram('tenderbot_poll_cycle_seconds', "Duration of a whole poll cycle", buckets=DEFAULT_BUCKETS)
+POLL_STAGE_SECONDS = Histogram(
+    'tenderbot_poll_stage_seconds',
+    "Duration of a poll cycle stage (load, fetch, match, dedup, persist)",
+    ['stage'],
+    buckets=DEFAULT_BUCKETS
+)
+GOSPLAN_REQUEST_SECONDS = Histogram(
+    'tenderbot_gosplan_request_seconds',
+    "Latency of GosPlan API requests including retries, by OKVED code",
+    ['code'],
+    buckets=DEFAULT_BUCKETS
+)
+GOSPLAN_REQUEST_FAILURES = Counter(
+    'tenderbot_gosplan_request_failures_total',
+    "GosPlan API requests that failed after all retries, by OKVED code",
+    ['code']
+)
+TENDERS_SEEN = Counter('tenderbot_tenders_seen_total', "Tenders fetched past the poll cursor")
+NOTIFICATIONS_NEW = Counter('tenderbot_notifications_new_total', "New notifications stored")
+NOTIFICATIONS_SENT = Counter('tenderbot_notifications_sent_total', "Notifications delivered to Telegram")
+NOTIFICATIONS_FAILED = Counter('tenderbot_notifications_failed_total', "Notifications given up on")
+SEND_QUEUE_DEPTH = Gauge('tenderbot_send_queue_depth', "Messages waiting in the send queue")
+WEBHOOK_REQUESTS = Counter(
+    'tenderbot_webhook_requests_total',
+    "Update requests posted to the webhook, by result (accepted, rejected, malformed)",
+    ['result']
+)
+USER_CACHE_LOOKUPS = Counter(
+    'tenderbot_user_cache_lookups_total',
+    "Lookups of user state by the conversation handlers, by result (hit, miss)",
+    ['result']
+)
+DB_QUERIES = Counter('tenderbot_db_queries_total', "SQL statements executed")
+TENDER_DETECTION_DELAY = Histogram(
+    'tenderbot_tender_detection_delay_seconds',
+    "Time from tender publication to its first notification being stored",
+    buckets=DELAY_BUCKETS
+)
+NOTIFICATION_DELIVERY_DELAY = Histogram(
+    'tenderbot_notification_delivery_delay_seconds',
+    "Time from storing a notification to delivering it",
+    buckets=DELAY_BUCKETS
+)
+SEND_REQUEST_SECONDS = Histogram(
+    'tenderbot_send_request_seconds',
+    "Latency of Telegram send_message calls, failed ones included",
+    buckets=DEFAULT_BUCKETS
+)
+
+
+def stage_timer(stage: str):
+    """Context manager timing one stage of the poll cycle."""
+    return POLL_STAGE_SECONDS.labels(stage).time()
+
+
+def track_db_queries(engine):
+    """Count every statement executed through `engine`."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        DB_QUERIES.inc()
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(REGISTRY), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Serve /metrics on host:port. Returns the runner to clean up on shutdown."""
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return runner
@@ -1,8 +1,11 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Boolean
+from sqlalchemy import create_engine, event, inspect, or_, text, Column, Integer, Float, String, DateTime, ForeignKey, Boolean, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from dotenv import load_dotenv
+import asyncio
 import os
 
 # Load environment variables
@@ -15,35 +18,253 @@ class User(Base):
     
     id = Column(Integer, primary_key=True)
     telegram_id = Column(Integer, unique=True)
-    okved_codes = Column(String)  # Будет хранить коды через запятую
+    okved_codes = Column(String)  # Устарело: коды перенесены в таблицу subscriptions
+    digest_mode = Column(Boolean, default=False)  # Присылать закупки одним сообщением-дайджестом
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationship with notifications
     notifications = relationship("Notification", back_populates="user")
+    # Relationship with subscriptions
+    subscriptions = relationship("Subscription", back_populates="user", cascade="all, delete-orphan")
+
+class Subscription(Base):
+    __tablename__ = 'subscriptions'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'code', name='uq_subscriptions_user_code'),
+        Index('ix_subscriptions_code', 'code'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
+    code = Column(String, nullable=False)  # Код ОКВЭД или раздел, например 62 или 62.01
+    # Фильтры подписки; пустое значение — без ограничения
+    include_keywords = Column(String, nullable=True)  # Через запятую: хотя бы одно слово в названии закупки
+    exclude_keywords = Column(String, nullable=True)  # Через запятую: ни одного из слов в названии
+    min_price = Column(Float, nullable=True)
+    max_price = Column(Float, nullable=True)
+    regions = Column(String, nullable=True)  # Коды регионов через запятую, например 77,50
+    min_days_left = Column(Integer, nullable=True)  # Минимум дней до окончания приёма заявок
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    # Relationship with user
+    user = relationship("User", back_populates="subscriptions")
+
+class Tender(Base):
+    __tablename__ = 'tenders'
+
+    id = Column(Integer, primary_key=True)
+    purchase_number = Column(String, unique=True, nullable=False)
+    name = Column(String)
+    amount = Column(Float)
+    currency_code = Column(String)
+    customer = Column(String)
+    url = Column(String)
+    published_at = Column(DateTime)
+    collecting_finished_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    # Relationship with notifications
+    notifications = relationship("Notification", back_populates="tender")
 
 class Notification(Base):
     __tablename__ = 'notifications'
+    __table_args__ = (
+        # Dedup lookup: has this user already been notified about this tender?
+        Index('ix_notifications_user_tender', 'user_id', 'tender_number', unique=True),
+        # Latest notification per user (status screen, last check time)
+        Index('ix_notifications_user_created', 'user_id', 'created_at'),
+    )
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
+    tender_id = Column(Integer, ForeignKey('tenders.id'), index=True)
     tender_number = Column(String)
-    tender_name = Column(String)
-    tender_amount = Column(Integer)
-    tender_url = Column(String)
+    okved_code = Column(String)  # Код, по которому найдена закупка
     is_sent = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     sent_at = Column(DateTime, nullable=True)
+    failed_at = Column(DateTime, nullable=True)  # Доставка невозможна (бот заблокирован и т.п.)
+    backfilled = Column(Boolean, default=False)  # Найдена догрузкой после простоя; отправляется в темпе догрузки
     
     # Relationship with user
     user = relationship("User", back_populates="notifications")
+    # Relationship with tender
+    tender = relationship("Tender", back_populates="notifications")
+
+class UserStats(Base):
+    __tablename__ = 'user_stats'
+
+    # Итоги по уведомлениям, удалённым при очистке старых записей (см. maintenance.py)
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    archived_notifications = Column(Integer, nullable=False, default=0)
+    archived_sent = Column(Integer, nullable=False, default=0)
+    last_notification_at = Column(DateTime, nullable=True)
+    last_sent_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class PollCursor(Base):
+    __tablename__ = 'poll_cursors'
+
+    code = Column(String, primary_key=True)  # Код ОКВЭД, по которому выполняется опрос
+    last_update_date = Column(DateTime)  # Дата обновления самой свежей обработанной закупки
+    last_purchase_number = Column(String)
+    last_success_at = Column(DateTime, nullable=True)  # Время последнего успешного опроса кода
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class PollBackfill(Base):
+    __tablename__ = 'poll_backfills'
+
+    # Догрузка закупок, пропущенных за время простоя: страницы от next_page и дальше,
+    # пока не встретится закупка с ключом target_*
+    id = Column(Integer, primary_key=True)
+    code = Column(String, nullable=False, index=True)
+    target_update_date = Column(DateTime)
+    target_purchase_number = Column(String)
+    next_page = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class PollWorker(Base):
+    __tablename__ = 'poll_workers'
+
+    owner = Column(String, primary_key=True)  # host:pid процесса опроса
+    shard_index = Column(Integer, nullable=False)
+    shard_count = Column(Integer, nullable=False)
+    heartbeat_at = Column(DateTime, nullable=False, index=True)
+
+class PollLease(Base):
+    __tablename__ = 'poll_leases'
+
+    code = Column(String, primary_key=True)  # Код ОКВЭД, который опрашивает владелец аренды
+    owner = Column(String, nullable=False, index=True)
+    expires_at = Column(DateTime, nullable=False)
 
 # Create database engine using environment variable
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///tenderbot.db')
 engine = create_engine(DATABASE_URL)
 
+if engine.dialect.name == 'sqlite':
+    @event.listens_for(engine, 'connect')
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        """Use WAL so that commits don't fsync the whole database file every time."""
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
 # Create all tables
 Base.metadata.create_all(engine)
 
 # Create session factory
-Session = sessionmaker(bind=engine) 
\ No newline at end of file
+Session = sessionmaker(bind=engine)
+
+# Dedicated threads for database work so that queries never block the event loop
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', 4))
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='db')
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking database function in the database thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, partial(func, *args, **kwargs))
+
+def migrate_okved_codes(session):
+    """Move comma-separated User.okved_codes into the subscriptions table."""
+    users = session.query(User).filter(User.okved_codes.isnot(None)).all()
+    for user in users:
+        existing = {sub.code for sub in user.subscriptions}
+        for code in user.okved_codes.split(','):
+            code = code.strip()
+            if code and code not in existing:
+                user.subscriptions.append(Subscription(code=code))
+                existing.add(code)
+        user.okved_codes = None
+    session.commit()
+    return len(users)
+
+def add_missing_columns(connection):
+    """Add columns that exist in the models but not yet in the database tables."""
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=connection.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+def retire_unsent_notifications(connection):
+    """Mark notifications left unsent before the send queue existed as failed.
+
+    They were only ever sent by the check that created them, so the sender
+    would otherwise deliver the whole old backlog right after the upgrade.
+    """
+    notifications = Notification.__table__
+    connection.execute(
+        notifications.update().where(
+            or_(notifications.c.is_sent.is_(False), notifications.c.is_sent.is_(None))
+        ).values(failed_at=datetime.utcnow())
+    )
+
+def create_missing_indexes(connection):
+    """Create indexes declared in the models that existing tables are missing."""
+    inspector = inspect(connection)
+    existing_notification_indexes = {index['name'] for index in inspector.get_indexes('notifications')}
+    if 'ix_notifications_user_tender' not in existing_notification_indexes:
+        # Older databases may contain duplicate notifications; keep the first one
+        connection.execute(text(
+            'DELETE FROM notifications WHERE id NOT IN '
+            '(SELECT MIN(id) FROM notifications GROUP BY user_id, tender_number)'
+        ))
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+def migrate_notification_tenders(connection):
+    """Move tender details copied into every notification into the shared tenders table."""
+    columns = {column['name'] for column in inspect(connection).get_columns('notifications')}
+    if 'tender_name' not in columns:
+        return
+    connection.execute(text(
+        'INSERT INTO tenders (purchase_number, name, amount, url, created_at) '
+        'SELECT tender_number, MAX(tender_name), MAX(tender_amount), MAX(tender_url), MIN(created_at) '
+        'FROM notifications '
+        'WHERE tender_number IS NOT NULL '
+        'AND tender_number NOT IN (SELECT purchase_number FROM tenders) '
+        'GROUP BY tender_number'
+    ))
+    connection.execute(text(
+        'UPDATE notifications SET tender_id = '
+        '(SELECT id FROM tenders WHERE tenders.purchase_number = notifications.tender_number) '
+        'WHERE tender_id IS NULL'
+    ))
+
+def enable_incremental_vacuum():
+    """Switch SQLite to auto_vacuum=INCREMENTAL so that freed pages can be returned bit by bit.
+
+    An existing database has to be rebuilt once with VACUUM for the mode to take effect.
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        if connection.exec_driver_sql('PRAGMA auto_vacuum').scalar() == 2:
+            return
+        connection.exec_driver_sql('PRAGMA auto_vacuum=INCREMENTAL')
+        connection.exec_driver_sql('VACUUM')
+
+def run_migrations():
+    """Bring an existing database up to date with the current models."""
+    enable_incremental_vacuum()
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        columns = {column['name'] for column in inspect(connection).get_columns('notifications')}
+        add_missing_columns(connection)
+        if 'failed_at' not in columns:
+            retire_unsent_notifications(connection)
+        migrate_notification_tenders(connection)
+        create_missing_indexes(connection)
+    session = Session()
+    try:
+        migrate_okved_codes(session)
+    finally:
+        session.close()
+ 
\ No newline at end of file
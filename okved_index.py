@@ -0,0 +1,93 @@
+import re
+
+from subscription_filters import FilterIndex
+
+# ОКВЭД 2: раздел XX, подкласс XX.X, группа XX.XX, подгруппа XX.XX.X, вид XX.XX.XX
+OKVED_PATTERN = re.compile(r'^\d{2}(\.\d{1,2}){0,2}$')
+
+
+def is_valid_okved(code: str) -> bool:
+    """Check that a string looks like an OKVED 2 code (62, 62.0, 62.01, 62.01.1)."""
+    return bool(OKVED_PATTERN.match(code))
+
+
+def okved_key(code: str) -> str:
+    """Return the digits of an OKVED code.
+
+    The dotted notation is strictly hierarchical digit by digit
+    (62 -> 62.0 -> 62.01 -> 62.01.1), so prefixes of the digit string
+    are exactly the ancestors of a code.
+    """
+    return ''.join(ch for ch in code if ch.isdigit())
+
+
+class _Node:
+    __slots__ = ('children', 'subscribers', 'matcher')
+
+    def __init__(self):
+        self.children = {}
+        self.subscribers = {}  # subscriber -> SubscriptionFilter or None
+        self.matcher = None  # FilterIndex compiled on first filtered match
+
+
+class OkvedIndex:
+    """In-memory prefix tree mapping OKVED codes to their subscribers.
+
+    A subscription to `62` matches tenders tagged `62.01` or `62.02.1`.
+    Each subscription may carry a SubscriptionFilter; the filters of a code
+    are compiled into a FilterIndex and checked once per tender.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._size = 0
+
+    def add(self, code: str, subscriber, subscription_filter=None):
+        """Subscribe `subscriber` to `code` and all codes below it."""
+        node = self._root
+        for digit in okved_key(code):
+            node = node.children.setdefault(digit, _Node())
+        if subscriber not in node.subscribers:
+            self._size += 1
+        node.subscribers[subscriber] = subscription_filter or None
+        node.matcher = None
+
+    def discard(self, code: str, subscriber):
+        """Remove a single subscription if present."""
+        node = self._root
+        for digit in okved_key(code):
+            node = node.children.get(digit)
+            if node is None:
+                return
+        if subscriber in node.subscribers:
+            del node.subscribers[subscriber]
+            node.matcher = None
+            self._size -= 1
+
+    def match(self, code: str, tender=None) -> set:
+        """Return every subscriber of `code` or of any of its ancestors.
+
+        With a tender (a ParsedTender), only subscribers whose filters accept
+        it are returned.
+        """
+        node = self._root
+        matched = self._match_node(node, tender)
+        for digit in okved_key(code):
+            node = node.children.get(digit)
+            if node is None:
+                break
+            matched.update(self._match_node(node, tender))
+        return matched
+
+    @staticmethod
+    def _match_node(node: _Node, tender) -> set:
+        if not node.subscribers:
+            return set()
+        if tender is None:
+            return set(node.subscribers)
+        if node.matcher is None:
+            node.matcher = FilterIndex(node.subscribers)
+        return node.matcher.match(tender)
+
+    def __len__(self):
+        return self._size
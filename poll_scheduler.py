@@ -0,0 +1,115 @@
+import heapq
+import random
+
+
+class _CodeState:
+    __slots__ = ('code', 'interval', 'rate', 'due_at', 'polled_at', 'running', 'version')
+
+    def __init__(self, code: str, interval: float, due_at: float):
+        self.code = code
+        self.interval = interval
+        self.rate = None
+        self.due_at = due_at
+        self.polled_at = None
+        self.running = False
+        self.version = 0
+
+
+class PollScheduler:
+    """Per-code poll schedule that adapts to how often each code gets new tenders.
+
+    Keeps a heap of next-due times. After each poll the code's arrival rate
+    (new tenders per second) is smoothed with an EWMA and its interval is set
+    so that a poll finds about `target_tenders` new tenders, within
+    [min_interval, max_interval]. Due times get random jitter so that polls
+    spread over time instead of bunching up. A code that is being polled is
+    not handed out again until its poll completes.
+
+    Times are plain floats from the caller's clock (e.g. loop.time()).
+    """
+
+    def __init__(self, min_interval: float, max_interval: float, initial_interval: float,
+                 target_tenders: float = 1.0, smoothing: float = 0.3, jitter: float = 0.1):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.initial_interval = min(max(initial_interval, self.min_interval), self.max_interval)
+        self.target_tenders = target_tenders
+        self.smoothing = smoothing
+        self.jitter = jitter
+        self._codes = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __contains__(self, code):
+        return code in self._codes
+
+    def interval(self, code: str):
+        """Current poll interval of a code in seconds, or None if it isn't scheduled."""
+        state = self._codes.get(code)
+        return state.interval if state else None
+
+    def _push(self, state: _CodeState):
+        # Entries are never removed from the heap; stale ones are skipped by version
+        state.version += 1
+        heapq.heappush(self._heap, (state.due_at, state.version, state.code))
+
+    def sync(self, codes, now: float):
+        """Make the schedule cover exactly `codes`.
+
+        New codes get their first poll spread randomly over the initial
+        interval; dropped codes are forgotten, even if a poll is running.
+        """
+        codes = set(codes)
+        for code in list(self._codes):
+            if code not in codes:
+                del self._codes[code]
+        for code in codes - self._codes.keys():
+            state = _CodeState(code, self.initial_interval, now + random.uniform(0, self.initial_interval))
+            self._codes[code] = state
+            self._push(state)
+
+    def next_due(self):
+        """Earliest due time of a code that is not being polled, or None."""
+        while self._heap:
+            due_at, version, code = self._heap[0]
+            state = self._codes.get(code)
+            if state is None or state.version != version or state.running:
+                heapq.heappop(self._heap)
+                continue
+            return due_at
+        return None
+
+    def take_due(self, until: float):
+        """Hand out the codes due by `until` and mark them as running."""
+        due = []
+        while self._heap and self.next_due() is not None and self._heap[0][0] <= until:
+            _, _, code = heapq.heappop(self._heap)
+            state = self._codes[code]
+            state.running = True
+            due.append(code)
+        return due
+
+    def complete(self, code: str, new_tenders, now: float):
+        """Record a finished poll and schedule the code's next one.
+
+        `new_tenders` is the number of tenders found past the cursor, or None
+        when the poll says nothing about the arrival rate (e.g. it failed or
+        the code had no cursor yet); the interval is then kept.
+        """
+        state = self._codes.get(code)
+        if state is None:
+            return
+        if new_tenders is not None and state.polled_at is not None:
+            elapsed = max(now - state.polled_at, 1e-6)
+            observed = new_tenders / elapsed
+            state.rate = observed if state.rate is None else (
+                self.smoothing * observed + (1 - self.smoothing) * state.rate
+            )
+            interval = self.target_tenders / state.rate if state.rate > 0 else self.max_interval
+            state.interval = min(max(interval, self.min_interval), self.max_interval)
+        state.polled_at = now
+        state.running = False
+        state.due_at = now + state.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        self._push(state)
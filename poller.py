@@ -0,0 +1,483 @@
+import os
+import logging
+import asyncio
+import socket
+import time
+from contextlib import aclosing
+from datetime import datetime
+from dotenv import load_dotenv
+from models import run_db
+from gosplan_client import GosPlanClient, GosPlanError
+from tender_store import SeenSet, ParsedTender, warm_seen_set, parse_purchases
+from poll_scheduler import PollScheduler
+from maintenance import retention_cutoff
+from metrics import (
+    METRICS_HOST, METRICS_PORT, POLL_CYCLE_SECONDS, GOSPLAN_REQUEST_SECONDS, GOSPLAN_REQUEST_FAILURES,
+    TENDERS_SEEN, stage_timer, start_metrics_server
+)
+import repository
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Constants from environment variables
+GOSPLAN_API_URL = os.getenv('GOSPLAN_API_URL', 'https://v2test.gosplan.info/fz44')
+CHECK_INTERVAL = int(os.getenv('CHECK_INTERVAL', 60))
+GOSPLAN_CONCURRENCY = int(os.getenv('GOSPLAN_CONCURRENCY', 10))  # Parallel API requests
+GOSPLAN_RATE_LIMIT = float(os.getenv('GOSPLAN_RATE_LIMIT', 5))  # Requests per second to the API host
+GOSPLAN_MAX_RETRIES = int(os.getenv('GOSPLAN_MAX_RETRIES', 3))
+GOSPLAN_TIMEOUT = int(os.getenv('GOSPLAN_TIMEOUT', 30))
+GOSPLAN_PAGE_SIZE = int(os.getenv('GOSPLAN_PAGE_SIZE', 50))
+GOSPLAN_MAX_PAGES = int(os.getenv('GOSPLAN_MAX_PAGES', 20))  # Safety cap on pages fetched per code and cycle
+GOSPLAN_STREAM_PARSE = os.getenv('GOSPLAN_STREAM_PARSE', '0') == '1'  # Parse pages while they download and stop at the cursor
+SEEN_CACHE_SIZE = int(os.getenv('SEEN_CACHE_SIZE', 100000))  # Notified (user, tender) pairs kept in memory
+DIGEST_WINDOW = int(os.getenv('DIGEST_WINDOW', 0))  # Seconds to collect digests; 0 sends one digest per check interval
+POLL_LEASE_TTL = int(os.getenv('POLL_LEASE_TTL', CHECK_INTERVAL * 3))  # Seconds before a lost poller's codes are taken over
+POLL_MIN_INTERVAL = int(os.getenv('POLL_MIN_INTERVAL', min(15, CHECK_INTERVAL)))  # Fastest poll interval of a busy code
+POLL_MAX_INTERVAL = int(os.getenv('POLL_MAX_INTERVAL', max(900, CHECK_INTERVAL)))  # Slowest poll interval of a quiet code
+POLL_TARGET_TENDERS = float(os.getenv('POLL_TARGET_TENDERS', 1))  # New tenders a poll of a code should find on average
+POLL_BATCH_WINDOW = float(os.getenv('POLL_BATCH_WINDOW', 1))  # Codes due within this many seconds are polled together
+CATCHUP_AFTER = int(os.getenv('CATCHUP_AFTER', 2 * POLL_MAX_INTERVAL))  # Seconds without a successful poll after which a code is backfilled
+CATCHUP_CONCURRENCY = int(os.getenv('CATCHUP_CONCURRENCY', 4))  # Backfill pages fetched in parallel
+CATCHUP_MAX_PAGES = int(os.getenv('CATCHUP_MAX_PAGES', 200))  # Safety cap on how deep a backfill pages
+
+def parse_shard(spec: str):
+    """Parse a shard spec like '1/4' into (index, count)."""
+    try:
+        index, count = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{spec}', expected i/N") from None
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard '{spec}', expected 0 <= i < N")
+    return index, count
+
+async def init_poller_state(state: dict, shard=(0, 1), render=True):
+    """Create the long-lived resources of the tender pipeline in `state`.
+
+    `render` is off for a standalone poller: it only stores notifications and
+    the front-end process delivers them.
+    """
+    client = GosPlanClient(
+        GOSPLAN_API_URL,
+        concurrency=GOSPLAN_CONCURRENCY,
+        rate_limit=GOSPLAN_RATE_LIMIT,
+        max_retries=GOSPLAN_MAX_RETRIES,
+        timeout=GOSPLAN_TIMEOUT
+    )
+    await client.start()
+    state['gosplan_client'] = client
+
+    seen = SeenSet(SEEN_CACHE_SIZE)
+    await run_db(warm_seen_set, seen)
+    state['seen_notifications'] = seen
+
+    state['poller_owner'] = f"{socket.gethostname()}:{os.getpid()}"
+    state['poller_shard'] = shard
+    state['poller_render'] = render
+
+async def close_poller_state(state: dict):
+    """Release resources created by init_poller_state."""
+    client = state.pop('gosplan_client', None)
+    if client:
+        await client.close()
+    owner = state.pop('poller_owner', None)
+    if owner:
+        await run_db(repository.release_poller, owner)
+
+async def _page_tenders(client: GosPlanClient, params):
+    """Yield the tenders of one API page as ParsedTender records. Raises GosPlanError on failure."""
+    if GOSPLAN_STREAM_PARSE:
+        async for tender in client.iter_json_array('purchases', params=params):
+            yield ParsedTender.from_api(tender)
+        return
+    tenders = await client.get_json('purchases', params=params, decode=parse_purchases)
+    if tenders is None:
+        raise GosPlanError(f"API request with params {params} failed")
+    for tender in tenders:
+        yield tender
+
+async def fetch_tenders(client: GosPlanClient, okved_code: str, cursor=None, first_page: int = 1,
+                        max_pages: int = GOSPLAN_MAX_PAGES):
+    """Fetch tenders for a single OKVED code that are newer than its cursor.
+
+    Pages through the API (newest first) from `first_page` until the cursor
+    is reached, at most `max_pages` pages. Without a cursor only one page is
+    taken. With GOSPLAN_STREAM_PARSE a page is read only up to the cursor.
+    Returns (ParsedTender records, newest_key, next_page), or None if a
+    request failed so that the cursor is not moved. `next_page` is None
+    when the cursor was reached, or else the page to continue from.
+
+    Tenders without an update date are kept but neither end the scan nor
+    move the cursor, and the cursor never moves backwards.
+    """
+    new_tenders = []
+    newest_key = None
+    next_page = None
+    pages = max_pages if cursor else 1
+    for page in range(first_page, first_page + pages):
+        params = {
+            'okved2': okved_code,
+            'sortBy': 'UPDATE_DATE',
+            'sortDirection': 'DESC',
+            'pageSize': GOSPLAN_PAGE_SIZE,
+            'page': page
+        }
+        logger.debug(f"Making API request to {GOSPLAN_API_URL}/purchases with params: {params}")
+        started = time.perf_counter()
+        received = 0
+        undated = 0
+        reached_cursor = False
+        try:
+            async with aclosing(_page_tenders(client, params)) as tenders:
+                async for tender in tenders:
+                    received += 1
+                    key = tender.update_key
+                    if key is None:
+                        undated += 1
+                        new_tenders.append(tender)
+                        continue
+                    if newest_key is None:
+                        newest_key = key
+                    if cursor:
+                        # Tenders with the cursor's own date may still be unseen; dedup sorts them out
+                        if key[0] < cursor[0] or key == cursor:
+                            reached_cursor = True
+                            break
+                    new_tenders.append(tender)
+        except GosPlanError as e:
+            logger.error(f"Error fetching OKVED {okved_code}: {e}")
+            GOSPLAN_REQUEST_FAILURES.labels(okved_code).inc()
+            return None
+        finally:
+            GOSPLAN_REQUEST_SECONDS.labels(okved_code).observe(time.perf_counter() - started)
+        logger.debug(f"Received {received} tenders for OKVED {okved_code} (page {page})")
+        if undated:
+            logger.warning(f"{undated} tenders for OKVED {okved_code} on page {page} have no update date")
+
+        if reached_cursor or received < GOSPLAN_PAGE_SIZE:
+            break
+    else:
+        if cursor:
+            next_page = first_page + pages
+
+    if newest_key and cursor:
+        newest_key = max(newest_key, cursor)
+    return new_tenders, newest_key or cursor, next_page
+
+async def refresh_poll_state(state: dict):
+    """Reload subscriptions and renew this poller's leases. Returns the leased codes."""
+    with stage_timer('load'):
+        index, user_ids, codes = await run_db(repository.load_poll_state)
+        logger.info(f"Found {len(user_ids)} users with OKVED codes")
+        if not user_ids:
+            logger.warning("No users with OKVED codes found!")
+
+        shard_index, shard_count = state['poller_shard']
+        codes = await run_db(
+            repository.claim_codes, codes, state['poller_owner'], shard_index, shard_count, POLL_LEASE_TTL
+        )
+    logger.info(f"Holding leases on {len(codes)} OKVED codes for {len(user_ids)} users (shard {shard_index}/{shard_count})")
+    state['poll_index'] = index
+    state['poll_codes'] = codes
+    return codes
+
+def _add_tender(tenders_by_number, tender, okved_code):
+    """Record that `tender` was returned for `okved_code`.
+
+    Values are (tender, codes fetched under, most specific first). Purchases
+    of the API carry no OKVED codes of their own, so the codes a tender was
+    returned for are all that is known about it; a tender listed under
+    sibling codes (62.01 and 62.02) must reach the subscribers of both.
+    """
+    known = tenders_by_number.get(tender.purchase_number)
+    if known is None:
+        tenders_by_number[tender.purchase_number] = (tender, (okved_code,))
+    elif okved_code not in known[1]:
+        codes = sorted(known[1] + (okved_code,), key=len, reverse=True)
+        tenders_by_number[tender.purchase_number] = (known[0], tuple(codes))
+
+def _match_candidates(index, tenders_by_number):
+    """Dict of (user_id, purchase_number) -> OKVED code for the users whose codes and filters accept each tender.
+
+    The code is the most specific one the tender was returned for among
+    those that reached the user, i.e. the one shown in their notification.
+    Tenders published before the retention cutoff are skipped: their
+    notifications may have been deleted already, so dedup could no longer
+    tell whether they were sent. Without a publication date the update date
+    is used, and a tender with neither is skipped as well.
+    """
+    cutoff = retention_cutoff()
+    candidates = {}
+    for number, (tender, okved_codes) in tenders_by_number.items():
+        if cutoff:
+            published_at = tender.published_at or tender.updated_at
+            if published_at is None or published_at.replace(tzinfo=None) < cutoff:
+                continue
+        for okved_code in okved_codes:
+            for user_id in index.match(okved_code, tender):
+                candidates.setdefault((user_id, number), okved_code)
+    return candidates
+
+async def poll_codes(state: dict, codes, render_digests: bool = not DIGEST_WINDOW):
+    """Run one fetch-dedup-persist pass over the given leased codes.
+
+    Each code is fetched once and every tender is dispatched to the users
+    subscribed to its code or any of its parent codes (from the index loaded
+    by refresh_poll_state). Database work runs in the database thread pool.
+
+    Returns (messages to deliver, dict of code -> number of tenders found
+    past the cursor). The count is None when a code failed or had no cursor
+    yet, since it then says nothing about how fast tenders arrive.
+    """
+    codes = list(codes)
+    index = state['poll_index']
+    cursors, last_success = await run_db(repository.get_cursors, codes)
+
+    # A code that wasn't polled for a while (e.g. the bot was down) only gets its
+    # newest page here; the rest of the gap is left to a backfill (see run_backfills)
+    now = datetime.utcnow()
+    lagging = {
+        code for code, polled_at in last_success.items()
+        if polled_at and (now - polled_at).total_seconds() > CATCHUP_AFTER
+    }
+
+    # Fetch all codes concurrently through the shared pooled client
+    client = state['gosplan_client']
+    with stage_timer('fetch'):
+        results = await asyncio.gather(
+            *(
+                fetch_tenders(client, code, cursors.get(code), max_pages=1 if code in lagging else GOSPLAN_MAX_PAGES)
+                for code in codes
+            ),
+            return_exceptions=True
+        )
+
+    with stage_timer('match'):
+        # A tender can come back under several codes (e.g. 62 and 62.01 or 62.01 and 62.02):
+        # keep it once together with every code it was fetched for
+        tenders_by_number = {}
+        cursor_updates = {}
+        counts = {}
+        polled = []
+        backfills_started = []
+        for okved_code, result in zip(codes, results):
+            counts[okved_code] = None
+            if isinstance(result, Exception):
+                logger.error(f"Unexpected error while fetching OKVED {okved_code}: {result}")
+                continue
+            if result is None:
+                continue
+            tenders, newest_key, next_page = result
+            polled.append(okved_code)
+            if next_page is not None:
+                # The cursor moves to the newest tender right away; the tenders between
+                # the old cursor and what was fetched are backfilled from next_page on
+                logger.info(
+                    f"OKVED {okved_code} has a gap since {last_success.get(okved_code) or cursors[okved_code][0]}, "
+                    f"backfilling from page {next_page}"
+                )
+                backfills_started.append((okved_code, cursors[okved_code], next_page))
+            elif okved_code in cursors:
+                counts[okved_code] = len(tenders)
+            if newest_key and newest_key != cursors.get(okved_code):
+                cursor_updates[okved_code] = newest_key
+            if not tenders:
+                logger.debug(f"No tenders found for OKVED {okved_code}")
+                continue
+            for tender in tenders:
+                _add_tender(tenders_by_number, tender, okved_code)
+        TENDERS_SEEN.inc(len(tenders_by_number))
+
+        # Every tender past the cursor goes to all users matching its code whose filters accept it
+        candidates = _match_candidates(index, tenders_by_number)
+
+    # Persist the whole pass's tenders, notifications and cursors in one transaction;
+    # dedup and persist stages are timed inside
+    messages = await run_db(
+        repository.save_cycle,
+        state['seen_notifications'],
+        tenders_by_number,
+        candidates,
+        cursor_updates,
+        render=state['poller_render'],
+        render_digests=render_digests,
+        polled=polled,
+        backfills_started=backfills_started
+    )
+    if backfills_started and 'backfill_wakeup' in state:
+        state['backfill_wakeup'].set()
+    return messages, counts
+
+async def run_poll_cycle(state: dict):
+    """Poll every leased code once. Returns the rendered messages to deliver."""
+    with POLL_CYCLE_SECONDS.time():
+        codes = await refresh_poll_state(state)
+        if not codes:
+            return []
+        messages, _ = await poll_codes(state, codes)
+        return messages
+
+async def run_backfill(state: dict, backfill, semaphore: asyncio.Semaphore, deliver=None) -> bool:
+    """Page through one gap, CATCHUP_CONCURRENCY pages at a time, checkpointing after each window.
+
+    `backfill` is (id, code, target key, next page) from repository.get_backfills.
+    Pages are counted from the newest tender, so tenders published meanwhile
+    shift the gap to later pages: resuming from a checkpoint then re-reads a
+    few tenders, which dedup drops, but never skips any. Returns True once
+    the target is reached, False if a request failed and the rest waits.
+    """
+    backfill_id, code, target, next_page = backfill
+    client = state['gosplan_client']
+
+    async def fetch_page(page):
+        async with semaphore:
+            return await fetch_tenders(client, code, target, first_page=page, max_pages=1)
+
+    while True:
+        if next_page > CATCHUP_MAX_PAGES:
+            logger.warning(f"Giving up backfill of OKVED {code} after {CATCHUP_MAX_PAGES} pages without reaching its target")
+            await run_db(repository.save_cycle, state['seen_notifications'], {}, {}, {}, backfill_progress={backfill_id: None})
+            return True
+
+        pages = range(next_page, min(next_page + CATCHUP_CONCURRENCY, CATCHUP_MAX_PAGES + 1))
+        results = await asyncio.gather(*(fetch_page(page) for page in pages))
+
+        # Only the pages before the first failed one count as done
+        tenders_by_number = {}
+        finished = False
+        fetched_until = next_page
+        for page, result in zip(pages, results):
+            if result is None:
+                break
+            tenders, _, more = result
+            for tender in tenders:
+                _add_tender(tenders_by_number, tender, code)
+            fetched_until = page + 1
+            if more is None:
+                finished = True
+                break
+        if fetched_until == next_page:
+            return False
+
+        TENDERS_SEEN.inc(len(tenders_by_number))
+        messages = await run_db(
+            repository.save_cycle,
+            state['seen_notifications'],
+            tenders_by_number,
+            _match_candidates(state['poll_index'], tenders_by_number),
+            {},
+            render=state['poller_render'],
+            render_digests=False,
+            backfilled=True,
+            backfill_progress={backfill_id: None if finished else fetched_until}
+        )
+        if deliver:
+            # Catch-up notifications are paced and yield to fresh ones
+            deliver(messages, paced=True)
+        if finished:
+            logger.info(f"Backfill of OKVED {code} finished at page {fetched_until - 1}")
+            return True
+        logger.info(f"Backfill of OKVED {code} checkpointed at page {fetched_until}")
+        if fetched_until <= pages[-1]:
+            return False
+        next_page = fetched_until
+
+async def run_backfills(state: dict, deliver=None):
+    """Backfill the gaps of the leased codes until cancelled.
+
+    Picks up gaps found by poll_codes as well as ones left unfinished by a
+    previous run, whatever process recorded them. Gaps of different codes
+    are paged in parallel, sharing CATCHUP_CONCURRENCY page requests.
+    """
+    wakeup = state.setdefault('backfill_wakeup', asyncio.Event())
+    semaphore = asyncio.Semaphore(CATCHUP_CONCURRENCY)
+    while True:
+        wakeup.clear()
+        codes = state.get('poll_codes') if 'poll_index' in state else None
+        try:
+            backfills = await run_db(repository.get_backfills, codes) if codes else []
+            if backfills:
+                logger.info(f"Backfilling {len(backfills)} gaps for {len({b[1] for b in backfills})} OKVED codes")
+                await asyncio.gather(*(run_backfill(state, backfill, semaphore, deliver) for backfill in backfills))
+        except Exception as e:
+            logger.error(f"Error backfilling OKVED codes: {e}")
+        # Unfinished gaps are retried on the next wakeup or after CHECK_INTERVAL
+        try:
+            await asyncio.wait_for(wakeup.wait(), CHECK_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+async def run_scheduled_polls(state: dict, deliver=None):
+    """Poll each leased code on its own adaptive schedule until cancelled.
+
+    Subscriptions and leases are refreshed every CHECK_INTERVAL. In between,
+    codes that come due are polled in small batches, one batch at a time, so
+    polls of a code never overlap. Busy codes are polled down to every
+    POLL_MIN_INTERVAL seconds and quiet ones up to every POLL_MAX_INTERVAL.
+    Rendered messages are passed to `deliver`. Digests are left to the digest
+    flush, since a batch covers only some of a user's codes. Gaps found
+    after downtime are backfilled by run_backfills in the background and
+    their messages are delivered with `paced=True`.
+    """
+    scheduler = PollScheduler(
+        POLL_MIN_INTERVAL,
+        POLL_MAX_INTERVAL,
+        initial_interval=CHECK_INTERVAL,
+        target_tenders=POLL_TARGET_TENDERS
+    )
+    state['poll_scheduler'] = scheduler
+    loop = asyncio.get_running_loop()
+    next_refresh = loop.time()
+    # Gaps left by downtime are backfilled alongside the regular polls
+    backfill_wakeup = state.setdefault('backfill_wakeup', asyncio.Event())
+    backfill_task = asyncio.create_task(run_backfills(state, deliver))
+    try:
+        while True:
+            if loop.time() >= next_refresh:
+                try:
+                    scheduler.sync(await refresh_poll_state(state), loop.time())
+                    backfill_wakeup.set()
+                except Exception as e:
+                    logger.error(f"Error refreshing poll state: {e}")
+                next_refresh = loop.time() + CHECK_INTERVAL
+
+            due = scheduler.take_due(loop.time() + POLL_BATCH_WINDOW) if 'poll_index' in state else []
+            if due:
+                logger.info(f"Polling {len(due)} due OKVED codes, {len(scheduler)} scheduled")
+                counts = {}
+                try:
+                    with POLL_CYCLE_SECONDS.time():
+                        messages, counts = await poll_codes(state, due, render_digests=False)
+                    if deliver:
+                        deliver(messages)
+                except Exception as e:
+                    logger.error(f"Error polling OKVED codes {due}: {e}")
+                finally:
+                    now = loop.time()
+                    for code in due:
+                        scheduler.complete(code, counts.get(code), now)
+                continue
+
+            next_due = scheduler.next_due()
+            wake_at = next_refresh if next_due is None else min(next_refresh, next_due)
+            await asyncio.sleep(max(0.0, wake_at - loop.time()))
+    finally:
+        backfill_task.cancel()
+        await asyncio.gather(backfill_task, return_exceptions=True)
+
+async def run_poller(shard=(0, 1)):
+    """Run only the tender pipeline: poll codes and store notifications."""
+    state = {}
+    metrics_runner = None
+    await init_poller_state(state, shard, render=False)
+    try:
+        if METRICS_PORT:
+            metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+        logger.info(f"Poller {state['poller_owner']} started for shard {shard[0]}/{shard[1]}")
+        await run_scheduled_polls(state)
+    finally:
+        await close_poller_state(state)
+        if metrics_runner:
+            await metrics_runner.cleanup()
@@ -0,0 +1,405 @@
+import logging
+import zlib
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, insert, or_
+from sqlalchemy.exc import IntegrityError
+
+from metrics import NOTIFICATIONS_NEW, stage_timer
+from models import Session, engine, User, UserStats, Subscription, Notification, PollWorker, PollLease
+from okved_index import OkvedIndex
+from subscription_filters import SubscriptionFilter
+from sender import render_messages
+from tender_store import (
+    store_tenders, filter_unseen, load_cursors, advance_cursors, load_backfills, checkpoint_backfills
+)
+from user_cache import UserState, user_cache
+
+logger = logging.getLogger(__name__)
+
+# Blocking data access used by the handlers and the poller. Every function
+# opens its own session and returns plain data, so it can be run in the
+# database thread pool with models.run_db. Per-user state for the handlers
+# is served from user_cache and written through on every change.
+
+
+def _get_or_create_user(session, telegram_id: int) -> User:
+    user = session.query(User).filter_by(telegram_id=telegram_id).first()
+    if not user:
+        user = User(telegram_id=telegram_id)
+        session.add(user)
+        session.commit()
+    return user
+
+
+def _cache_user_state(session, user: User) -> UserState:
+    codes = [sub.code for sub in sorted(user.subscriptions, key=lambda sub: sub.id or 0)]
+    # Live rows only cover the retention window; older ones are summed up in user_stats
+    total, sent, last_check, last_sent_at = session.query(
+        func.count(Notification.id),
+        func.count(Notification.sent_at),
+        func.max(Notification.created_at),
+        func.max(Notification.sent_at)
+    ).filter(Notification.user_id == user.id).one()
+    stats = session.get(UserStats, user.id)
+    if stats:
+        total += stats.archived_notifications
+        sent += stats.archived_sent
+        last_check = max(filter(None, (last_check, stats.last_notification_at)), default=None)
+        last_sent_at = max(filter(None, (last_sent_at, stats.last_sent_at)), default=None)
+    state = UserState(user.id, codes, bool(user.digest_mode), last_check, total, sent, last_sent_at)
+    user_cache.put(user.telegram_id, state)
+    return state
+
+
+def _get_user_state(telegram_id: int, create: bool = False):
+    """Cached state of the user, loading it on a miss; None for unknown users unless `create`."""
+    state = user_cache.get(telegram_id)
+    if state is not None:
+        return state
+    session = Session()
+    try:
+        if create:
+            user = _get_or_create_user(session, telegram_id)
+        else:
+            user = session.query(User).filter_by(telegram_id=telegram_id).first()
+            if not user:
+                return None
+        return _cache_user_state(session, user)
+    finally:
+        session.close()
+
+
+def ensure_user(telegram_id: int):
+    """Create the user on first contact."""
+    _get_user_state(telegram_id, create=True)
+
+
+def get_user_codes(telegram_id: int):
+    """Return the user's subscribed codes, or an empty list for unknown users."""
+    state = _get_user_state(telegram_id)
+    return list(state.codes) if state else []
+
+
+def add_subscription(telegram_id: int, code: str):
+    """Subscribe the user to a code. Returns the user's codes afterwards."""
+    state = _get_user_state(telegram_id, create=True)
+    if code in state.codes:
+        return list(state.codes)
+    session = Session()
+    try:
+        user = _get_or_create_user(session, telegram_id)
+        codes = [sub.code for sub in user.subscriptions]
+        if code not in codes:
+            user.subscriptions.append(Subscription(code=code))
+            session.commit()
+            codes.append(code)
+        user_cache.update(telegram_id, codes=codes)
+        return codes
+    finally:
+        session.close()
+
+
+def remove_subscription(telegram_id: int, code: str):
+    """Unsubscribe the user from a code. Returns (removed, remaining codes)."""
+    state = _get_user_state(telegram_id)
+    if not state:
+        return False, []
+    if code not in state.codes:
+        return False, list(state.codes)
+    session = Session()
+    try:
+        user = session.query(User).filter_by(telegram_id=telegram_id).first()
+        if not user:
+            user_cache.invalidate(telegram_id)
+            return False, []
+        subscription = next((sub for sub in user.subscriptions if sub.code == code), None)
+        if subscription:
+            user.subscriptions.remove(subscription)
+            session.commit()
+        codes = [sub.code for sub in user.subscriptions]
+        user_cache.update(telegram_id, codes=codes)
+        return subscription is not None, codes
+    finally:
+        session.close()
+
+
+def get_user_status(telegram_id: int):
+    """Return codes, last check time, digest mode and notification counts for the status screen, or None."""
+    state = _get_user_state(telegram_id)
+    if not state:
+        return None
+    return {
+        'codes': list(state.codes),
+        'last_check': state.last_check,
+        'digest_mode': state.digest_mode,
+        'notifications_total': state.notifications_total,
+        'notifications_sent': state.notifications_sent,
+        'last_sent_at': state.last_sent_at,
+    }
+
+
+FILTER_FIELDS = ('include_keywords', 'exclude_keywords', 'min_price', 'max_price', 'regions', 'min_days_left')
+
+
+def _subscription_filter(subscription: Subscription) -> SubscriptionFilter:
+    return SubscriptionFilter.from_columns(**{field: getattr(subscription, field) for field in FILTER_FIELDS})
+
+
+def _find_subscription(session, telegram_id: int, code: str):
+    return session.query(Subscription).join(User).filter(
+        User.telegram_id == telegram_id,
+        Subscription.code == code
+    ).first()
+
+
+def get_subscription_filter(telegram_id: int, code: str):
+    """Return the filter columns of the user's subscription to `code` as a dict, or None."""
+    session = Session()
+    try:
+        subscription = _find_subscription(session, telegram_id, code)
+        if not subscription:
+            return None
+        return {field: getattr(subscription, field) for field in FILTER_FIELDS}
+    finally:
+        session.close()
+
+
+def update_subscription_filter(telegram_id: int, code: str, **values):
+    """Set filter columns of the user's subscription to `code`; None clears a filter.
+
+    Returns the updated filter dict, or None if there is no such subscription.
+    """
+    unknown = set(values) - set(FILTER_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown filter fields: {unknown}")
+    session = Session()
+    try:
+        subscription = _find_subscription(session, telegram_id, code)
+        if not subscription:
+            return None
+        for field, value in values.items():
+            setattr(subscription, field, value)
+        session.commit()
+        return {field: getattr(subscription, field) for field in FILTER_FIELDS}
+    finally:
+        session.close()
+
+
+def toggle_digest(telegram_id: int) -> bool:
+    """Flip the user's digest mode. Returns the new value."""
+    session = Session()
+    try:
+        user = _get_or_create_user(session, telegram_id)
+        user.digest_mode = not user.digest_mode
+        session.commit()
+        user_cache.update(telegram_id, digest_mode=user.digest_mode)
+        return user.digest_mode
+    finally:
+        session.close()
+
+
+def load_poll_state():
+    """Load all subscriptions into a prefix index.
+
+    Returns (index of OKVED code -> user ids, subscribed user ids, codes).
+    """
+    session = Session()
+    try:
+        index = OkvedIndex()
+        user_ids = set()
+        codes = set()
+        for subscription in session.query(Subscription):
+            index.add(subscription.code, subscription.user_id, _subscription_filter(subscription))
+            user_ids.add(subscription.user_id)
+            codes.add(subscription.code)
+        return index, user_ids, codes
+    finally:
+        session.close()
+
+
+def get_cursors(codes):
+    """Return the poll cursors of the given codes and when each was last polled successfully."""
+    session = Session()
+    try:
+        return load_cursors(session, codes)
+    finally:
+        session.close()
+
+
+def get_backfills(codes):
+    """Return the unfinished backfills of the given codes."""
+    session = Session()
+    try:
+        return load_backfills(session, codes)
+    finally:
+        session.close()
+
+
+def shard_of(code: str, shard_count: int) -> int:
+    """Stable shard number of an OKVED code."""
+    return zlib.crc32(code.encode()) % shard_count
+
+
+def _insert_leases(session, rows):
+    """Insert lease rows, skipping codes that somebody else inserted first."""
+    if engine.dialect.name in ('sqlite', 'postgresql'):
+        if engine.dialect.name == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert
+        session.execute(insert(PollLease).values(rows).on_conflict_do_nothing(index_elements=['code']))
+        return
+    for row in rows:
+        try:
+            with session.begin_nested():
+                session.add(PollLease(**row))
+        except IntegrityError:
+            pass
+
+
+def claim_codes(codes, owner: str, shard_index: int, shard_count: int, ttl: int):
+    """Heartbeat this poller and lease the codes it should poll in this cycle.
+
+    A poller wants the codes of its own shard, plus codes that no live poller
+    covers (e.g. after a worker was lost). A lease is taken only if it is free,
+    expired or already ours, so two pollers never work on the same code at
+    once. Leases on codes that are no longer wanted are released. Returns the
+    set of leased codes.
+    """
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=ttl)
+    session = Session()
+    try:
+        session.merge(PollWorker(owner=owner, shard_index=shard_index, shard_count=shard_count, heartbeat_at=now))
+        live_shards = {
+            (worker.shard_index, worker.shard_count)
+            for worker in session.query(PollWorker).filter(PollWorker.heartbeat_at >= now - timedelta(seconds=ttl))
+        }
+
+        wanted = []
+        for code in codes:
+            if shard_of(code, shard_count) == shard_index:
+                wanted.append(code)
+            elif not any(shard_of(code, count) == index for index, count in live_shards):
+                wanted.append(code)
+
+        session.query(PollLease).filter(
+            PollLease.owner == owner,
+            PollLease.code.notin_(wanted)
+        ).delete(synchronize_session=False)
+        if not wanted:
+            session.commit()
+            return set()
+
+        session.query(PollLease).filter(
+            PollLease.code.in_(wanted),
+            or_(PollLease.owner == owner, PollLease.expires_at < now)
+        ).update({'owner': owner, 'expires_at': expires_at}, synchronize_session=False)
+        _insert_leases(session, [{'code': code, 'owner': owner, 'expires_at': expires_at} for code in wanted])
+        acquired = {
+            code for code, in session.query(PollLease.code).filter(
+                PollLease.code.in_(wanted),
+                PollLease.owner == owner
+            )
+        }
+        session.commit()
+        return acquired
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def release_poller(owner: str):
+    """Drop the poller's heartbeat and leases so other workers can take over at once."""
+    session = Session()
+    try:
+        session.query(PollLease).filter(PollLease.owner == owner).delete(synchronize_session=False)
+        session.query(PollWorker).filter(PollWorker.owner == owner).delete(synchronize_session=False)
+        session.commit()
+    finally:
+        session.close()
+
+
+def save_cycle(seen, tenders_by_number, candidates, cursor_updates, **options):
+    """Store the outcome of a poll cycle in one transaction.
+
+    `candidates` maps (user_id, purchase_number) to the OKVED code the tender
+    reached that user by. Drops already notified candidates, stores new
+    tenders and notifications and advances the cursors. Returns the rendered
+    messages to queue for delivery (none if `render` is off).
+
+    Options: `render`, `render_digests`, `polled` (codes fetched successfully),
+    `backfilled` (notifications come from a backfill and are sent paced),
+    `backfills_started` and `backfill_progress` (see
+    tender_store.checkpoint_backfills). Backfill checkpoints are committed
+    together with the notifications they produced, so a crash never skips
+    part of a gap.
+
+    Another poller may store the same notification concurrently (e.g. a tender
+    fetched under both 62 and 62.01); the unique index then rejects the
+    transaction and it is retried against the updated table.
+    """
+    for attempt in range(3):
+        try:
+            return _save_cycle(seen, tenders_by_number, candidates, cursor_updates, **options)
+        except IntegrityError as e:
+            logger.warning(f"Concurrent write while saving poll cycle, retrying: {e}")
+    return _save_cycle(seen, tenders_by_number, candidates, cursor_updates, **options)
+
+
+def _save_cycle(seen, tenders_by_number, candidates, cursor_updates, render=True, render_digests=True,
+                polled=(), backfilled=False, backfills_started=(), backfill_progress=None):
+    session = Session()
+    try:
+        # Reject already notified pairs, mostly without touching the database
+        with stage_timer('dedup'):
+            new_pairs = filter_unseen(session, seen, candidates)
+        logger.info(f"Found {len(new_pairs)} new notifications out of {len(candidates)} candidates")
+
+        with stage_timer('persist'):
+            messages = []
+            if new_pairs:
+                stored = store_tenders(session, [tenders_by_number[number][0] for number in {n for _, n in new_pairs}])
+                users = {
+                    user.id: user
+                    for user in session.query(User).filter(User.id.in_({user_id for user_id, _ in new_pairs}))
+                }
+                # Inserted in multi-row batches; user and tender resolve from the session without queries
+                notifications = session.scalars(
+                    insert(Notification).returning(Notification),
+                    [
+                        {
+                            'user_id': user_id,
+                            'tender_id': stored[number].id,
+                            'tender_number': number,
+                            'okved_code': candidates[(user_id, number)],
+                            'backfilled': backfilled
+                        }
+                        for user_id, number in new_pairs
+                    ]
+                ).all()
+                notifications.sort(key=lambda notification: notification.id)
+            advance_cursors(session, cursor_updates, polled)
+            checkpoint_backfills(session, backfills_started, backfill_progress)
+            session.flush()
+
+            if new_pairs and render:
+                messages = render_messages(notifications, render_digests)
+            # Read before commit expires the objects and every attribute access reloads its row
+            created_at_by_user = {
+                notification.user.telegram_id: notification.created_at for notification in notifications
+            } if new_pairs else {}
+            session.commit()
+        NOTIFICATIONS_NEW.inc(len(new_pairs))
+        user_cache.note_notifications(created_at_by_user)
+        for pair in new_pairs:
+            seen.add(pair)
+        return messages
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
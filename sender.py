@@ -0,0 +1,482 @@
+import asyncio
+import html
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy.orm import joinedload
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import ParseMode
+from telegram.error import RetryAfter, Forbidden, BadRequest
+
+from metrics import NOTIFICATIONS_SENT, NOTIFICATIONS_FAILED, NOTIFICATION_DELIVERY_DELAY, SEND_REQUEST_SECONDS
+from models import Session, User, Notification, run_db
+from user_cache import user_cache
+
+logger = logging.getLogger(__name__)
+
+# Telegram's limit on the length of a single message
+MAX_MESSAGE_LENGTH = 4096
+
+
+class RenderCache:
+    """Thread-safe LRU of rendered message parts.
+
+    Stored tenders never change, so a tender's text is rendered once and
+    shared by every recipient, digest and retry. Rendering runs in the
+    database threads, hence the lock.
+    """
+
+    def __init__(self, capacity: int = 10000):
+        self.capacity = capacity
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, render):
+        """Return the cached value for `key`, calling `render()` on a miss."""
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+        value = render()
+        with self._lock:
+            self._items[key] = value
+            if len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self._items)
+
+
+render_cache = RenderCache()
+
+
+def render_notification(notification: Notification):
+    """Build the message text and keyboard for a stored notification.
+
+    The result depends only on the tender and the code it was found under,
+    so it is cached by (purchase number, OKVED code).
+    """
+    tender = notification.tender
+    return render_cache.get(
+        ('message', tender.purchase_number, notification.okved_code),
+        lambda: _render_notification(tender, notification.okved_code)
+    )
+
+
+def _render_notification(tender, okved_code):
+    finished_at = tender.collecting_finished_at.strftime('%d.%m.%Y %H:%M') if tender.collecting_finished_at else 'Не указан'
+    published_at = tender.published_at.strftime('%d.%m.%Y %H:%M') if tender.published_at else 'Не указана'
+    text = (
+        f"🔔 Новая закупка!\n\n"
+        f"📋 Номер: {tender.purchase_number}\n"
+        f"📝 Название: {tender.name or 'Нет описания'}\n"
+        f"💰 Сумма: {tender.amount or 0:,.2f} {tender.currency_code or 'RUB'}\n"
+        f"📅 Дата публикации: {published_at}\n"
+        f"⏰ Прием заявок до: {finished_at}\n"
+        f"🏢 Заказчик: {tender.customer or 'Не указан'}\n"
+        f"🔍 ОКВЭД: {okved_code}\n"
+    )
+    keyboard = [[InlineKeyboardButton("🔍 Подробнее", url=tender.url)]]
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+def render_digest_line(notification: Notification):
+    """Compact one-line HTML summary of a tender for digest messages, cached by purchase number."""
+    tender = notification.tender
+    return render_cache.get(('digest', tender.purchase_number), lambda: _render_digest_line(tender))
+
+
+def _render_digest_line(tender):
+    name = tender.name or 'Нет описания'
+    if len(name) > 200:
+        name = name[:200] + '…'
+    finished_at = f", до {tender.collecting_finished_at.strftime('%d.%m.%Y %H:%M')}" if tender.collecting_finished_at else ''
+    return (
+        f'• <a href="{html.escape(tender.url or "", quote=True)}">{html.escape(tender.purchase_number)}</a> '
+        f'{html.escape(name)} — {tender.amount or 0:,.2f} {html.escape(tender.currency_code or "RUB")}{finished_at}\n'
+    )
+
+
+def render_digest(notifications):
+    """Split a user's notifications into as few digest messages as the length limit allows.
+
+    Returns a list of (text, notification_ids).
+    """
+    total = len(notifications)
+    chunks = []
+    lines, ids = [], []
+    header = f"🗞 Новые закупки: {total}\n\n"
+    length = len(header)
+    for notification in notifications:
+        line = render_digest_line(notification)
+        if lines and length + len(line) > MAX_MESSAGE_LENGTH:
+            chunks.append((header + ''.join(lines), ids))
+            header = "🗞 Новые закупки (продолжение)\n\n"
+            lines, ids = [], []
+            length = len(header)
+        lines.append(line)
+        ids.append(notification.id)
+        length += len(line)
+    if lines:
+        chunks.append((header + ''.join(lines), ids))
+    return chunks
+
+
+def render_messages(notifications, render_digests: bool = True):
+    """Render stored notifications into queue items, grouping digest users' ones.
+
+    With render_digests off, notifications of digest users are skipped; they
+    are picked up later by the digest flush.
+    """
+    messages = []
+    digests = {}
+    for notification in notifications:
+        if notification.user.digest_mode:
+            digests.setdefault(notification.user_id, []).append(notification)
+        else:
+            messages.append(NotificationSender.make_message(notification))
+    if render_digests:
+        for user_notifications in digests.values():
+            messages.extend(NotificationSender.make_digest_messages(user_notifications))
+    return messages
+
+
+class OutgoingMessage:
+    """A rendered message waiting in the send queue; a digest covers several notifications."""
+
+    __slots__ = ('notification_ids', 'chat_id', 'text', 'reply_markup', 'parse_mode', 'attempts', 'created_at')
+
+    def __init__(self, notification_ids, chat_id, text, reply_markup=None, parse_mode=None, created_at=None):
+        self.notification_ids = tuple(notification_ids)
+        self.chat_id = chat_id
+        self.text = text
+        self.reply_markup = reply_markup
+        self.parse_mode = parse_mode
+        self.attempts = 0
+        # When the oldest of the notifications was stored (UTC), for delivery delay metrics
+        self.created_at = created_at
+
+
+class TokenBucket:
+    """Token bucket allowing `rate` operations per second with bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Stop handing out tokens for `seconds` (e.g. after a flood-control error)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class NotificationSender:
+    """Delivers notifications from a durable queue backed by unsent Notification rows.
+
+    Fetching only persists notifications and enqueues them; a configurable
+    number of worker tasks delivers them while respecting Telegram's global
+    and per-chat rate limits and RetryAfter. Rows that are still unsent are
+    re-queued on start and by enqueue_unsent, so nothing is lost across
+    restarts. Only Forbidden and BadRequest mark a row as failed; after
+    `max_attempts` transient errors a message is dropped from the queue and
+    its rows wait, unsent, for the next enqueue_unsent.
+    """
+
+    def __init__(self, bot, workers: int = 4, global_rate: float = 30, per_chat_rate: float = 1,
+                 max_attempts: int = 5, batch_size: int = 500, catchup_rate: float = None,
+                 pickup_rescan: float = 60):
+        self.bot = bot
+        self.workers = workers
+        self.global_bucket = TokenBucket(global_rate)
+        self.per_chat_interval = 1.0 / per_chat_rate
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        # Paced (catch-up) messages are spread out at this rate and queue behind fresh ones
+        self.catchup_interval = 1.0 / catchup_rate if catchup_rate else 0.0
+        self._catchup_next_slot = 0.0
+        # Pickups only read ids above this mark; rows stored in the last `pickup_rescan`
+        # seconds stay above it, since their transactions may commit out of id order
+        self.pickup_rescan = pickup_rescan
+        self._pickup_after = 0
+        self._pickup_rewinds = 0
+        self._queue = asyncio.PriorityQueue()
+        self._counter = itertools.count()
+        self._queued_ids = set()
+        # Delivered or given up on, but not yet marked so in the database by flush()
+        self._unflushed_ids = set()
+        self._chat_next_slot = {}
+        self._sent = []
+        self._failed = []
+        self._tasks = []
+
+    async def start(self):
+        """Re-queue unsent notifications and start the workers."""
+        await self.enqueue_unsent()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._flusher()))
+        logger.info(f"Notification sender started with {self.workers} workers, {self._queue.qsize()} queued")
+
+    async def stop(self):
+        """Stop the workers and persist sent status collected so far."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+
+    @property
+    def queue_size(self):
+        return self._queue.qsize()
+
+    async def drain(self):
+        """Wait until every queued message is delivered or given up on."""
+        await self._queue.join()
+        await self.flush()
+
+    async def enqueue_unsent(self, digest_only: bool = False, include_digests: bool = True, telegram_id: int = None,
+                             new_only: bool = False):
+        """Queue notifications that were stored but never delivered.
+
+        Notifications of users in digest mode are grouped into digests, or
+        left for a later digest flush when include_digests is off. Ones stored
+        by a backfill are paced, whichever process stored them. With
+        `telegram_id`, only that user's notifications are queued. With
+        `new_only`, only rows stored since the previous new_only call are
+        read, plus those of messages postponed after send errors.
+        """
+        skip_ids = self._queued_ids | self._unflushed_ids
+        after_id = self._pickup_after if new_only else 0
+        rewinds = self._pickup_rewinds
+        settled_before = datetime.utcnow() - timedelta(seconds=self.pickup_rescan) if new_only else None
+        messages, backfill_messages, settled_id = await run_db(
+            self._load_unsent, digest_only, include_digests, skip_ids, telegram_id, after_id, settled_before
+        )
+        if new_only and rewinds == self._pickup_rewinds:
+            self._pickup_after = max(after_id, settled_id)
+        self.submit(messages)
+        self.submit(backfill_messages, paced=True)
+
+    def _load_unsent(self, digest_only, include_digests, skip_ids, telegram_id=None, after_id=0, settled_before=None):
+        session = Session()
+        try:
+            settled_id = after_id
+            if settled_before is not None:
+                # Walks the primary key down from the newest row, so only recent rows are read
+                newest_settled = session.query(Notification.id).filter(
+                    Notification.id > after_id, Notification.created_at < settled_before
+                ).order_by(Notification.id.desc()).limit(1).scalar()
+                settled_id = newest_settled or after_id
+            query = session.query(Notification).options(
+                joinedload(Notification.tender), joinedload(Notification.user)
+            ).filter(
+                Notification.id > after_id,
+                Notification.is_sent.isnot(True),
+                Notification.failed_at.is_(None)
+            )
+            if digest_only or not include_digests or telegram_id is not None:
+                query = query.join(Notification.user)
+            if digest_only:
+                query = query.filter(User.digest_mode.is_(True))
+            elif not include_digests:
+                query = query.filter(User.digest_mode.isnot(True))
+            if telegram_id is not None:
+                query = query.filter(User.telegram_id == telegram_id)
+            notifications = [
+                notification for notification in query.order_by(Notification.id)
+                if notification.id not in skip_ids
+            ]
+            # Notifications stored by a separate poller process reach this process here
+            user_cache.note_notifications({
+                notification.user.telegram_id: notification.created_at for notification in notifications
+            })
+            # A digest is a single message per user, so it is never worth pacing
+            backfilled = [
+                notification for notification in notifications
+                if notification.backfilled and not notification.user.digest_mode
+            ]
+            fresh = [
+                notification for notification in notifications
+                if not notification.backfilled or notification.user.digest_mode
+            ]
+            return render_messages(fresh, include_digests), render_messages(backfilled), settled_id
+        finally:
+            session.close()
+
+    @staticmethod
+    def make_message(notification: Notification) -> OutgoingMessage:
+        """Render a notification into a queue item. Tender and user must be loaded."""
+        text, reply_markup = render_notification(notification)
+        return OutgoingMessage(
+            (notification.id,), notification.user.telegram_id, text, reply_markup,
+            created_at=notification.created_at
+        )
+
+    @staticmethod
+    def make_digest_messages(notifications):
+        """Render one user's notifications into digest queue items."""
+        chat_id = notifications[0].user.telegram_id
+        created_at = {notification.id: notification.created_at for notification in notifications}
+        return [
+            OutgoingMessage(
+                ids, chat_id, text, parse_mode=ParseMode.HTML,
+                created_at=min((created_at[i] for i in ids if created_at[i]), default=None)
+            )
+            for text, ids in render_digest(notifications)
+        ]
+
+    def submit(self, messages, paced: bool = False):
+        """Queue rendered messages whose notifications are already committed.
+
+        `paced` messages (e.g. a backfill after downtime) are released at the
+        catch-up rate, so they neither trip flood limits nor hold up fresh ones.
+        """
+        for message in messages:
+            if self._queued_ids.isdisjoint(message.notification_ids) and \
+                    self._unflushed_ids.isdisjoint(message.notification_ids):
+                ready_at = 0.0
+                if paced and self.catchup_interval:
+                    ready_at = max(time.monotonic(), self._catchup_next_slot)
+                    self._catchup_next_slot = ready_at + self.catchup_interval
+                self._put(message, ready_at)
+
+    def _put(self, message: OutgoingMessage, ready_at: float = 0.0):
+        self._queued_ids.update(message.notification_ids)
+        self._queue.put_nowait((ready_at, next(self._counter), message))
+
+    async def _worker(self):
+        while True:
+            ready_at, _, message = await self._queue.get()
+            try:
+                now = time.monotonic()
+                if ready_at > now:
+                    # Nothing earlier is queued; wait a little and look again
+                    self._queue.put_nowait((ready_at, next(self._counter), message))
+                    await asyncio.sleep(min(ready_at - now, 0.5))
+                    continue
+
+                chat_slot = self._chat_next_slot.get(message.chat_id, 0.0)
+                if chat_slot > now:
+                    self._queue.put_nowait((chat_slot, next(self._counter), message))
+                    continue
+                self._chat_next_slot[message.chat_id] = now + self.per_chat_interval
+
+                await self.global_bucket.acquire()
+                await self._send(message)
+            finally:
+                self._queue.task_done()
+
+    async def _send(self, message: OutgoingMessage):
+        message.attempts += 1
+        try:
+            with SEND_REQUEST_SECONDS.time():
+                await self.bot.send_message(
+                    chat_id=message.chat_id,
+                    text=message.text,
+                    reply_markup=message.reply_markup,
+                    parse_mode=message.parse_mode
+                )
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+            logger.warning(f"Flood control for chat {message.chat_id}, retrying in {retry_after} seconds")
+            self.global_bucket.pause(retry_after)
+            self._chat_next_slot[message.chat_id] = time.monotonic() + retry_after
+            # Flood control is not the message's fault, so it doesn't count as an attempt
+            message.attempts -= 1
+            self._queue.put_nowait((time.monotonic() + retry_after, next(self._counter), message))
+            return
+        except (Forbidden, BadRequest) as e:
+            logger.error(f"Error sending message to user {message.chat_id}: {e}")
+            self._fail(message)
+            return
+        except Exception as e:
+            if message.attempts >= self.max_attempts:
+                logger.error(
+                    f"Postponing notifications {message.notification_ids} for user {message.chat_id} "
+                    f"until the next pickup: {e}"
+                )
+                self._queued_ids.difference_update(message.notification_ids)
+                # Make the next pickup read these rows again
+                self._pickup_after = min(self._pickup_after, min(message.notification_ids) - 1)
+                self._pickup_rewinds += 1
+            else:
+                delay = 2 ** message.attempts
+                logger.warning(f"Error sending message to user {message.chat_id}: {e}, retrying in {delay} seconds")
+                self._queue.put_nowait((time.monotonic() + delay, next(self._counter), message))
+            return
+
+        logger.debug(f"Successfully sent notifications {message.notification_ids} to user {message.chat_id}")
+        self._unflushed_ids.update(message.notification_ids)
+        self._queued_ids.difference_update(message.notification_ids)
+        sent_at = datetime.utcnow()
+        NOTIFICATIONS_SENT.inc(len(message.notification_ids))
+        if message.created_at:
+            NOTIFICATION_DELIVERY_DELAY.observe(max((sent_at - message.created_at).total_seconds(), 0.0))
+        self._sent.extend((notification_id, sent_at) for notification_id in message.notification_ids)
+        if len(self._sent) >= self.batch_size:
+            await self.flush()
+
+    def _fail(self, message: OutgoingMessage):
+        self._unflushed_ids.update(message.notification_ids)
+        self._queued_ids.difference_update(message.notification_ids)
+        NOTIFICATIONS_FAILED.inc(len(message.notification_ids))
+        failed_at = datetime.utcnow()
+        self._failed.extend((notification_id, failed_at) for notification_id in message.notification_ids)
+
+    async def flush(self):
+        """Bulk-update sent and failed status of delivered notifications."""
+        if not self._sent and not self._failed:
+            return
+        sent, self._sent = self._sent, []
+        failed, self._failed = self._failed, []
+        try:
+            await run_db(self._save_status, sent, failed)
+        except Exception as e:
+            self._sent.extend(sent)
+            self._failed.extend(failed)
+            logger.error(f"Error saving notification status: {e}")
+            return
+        # Only now would _load_unsent see these rows as handled
+        self._unflushed_ids.difference_update(notification_id for notification_id, _ in sent)
+        self._unflushed_ids.difference_update(notification_id for notification_id, _ in failed)
+
+    @staticmethod
+    def _save_status(sent, failed):
+        session = Session()
+        try:
+            session.bulk_update_mappings(Notification, [
+                {'id': notification_id, 'is_sent': True, 'sent_at': sent_at}
+                for notification_id, sent_at in sent
+            ] + [
+                {'id': notification_id, 'failed_at': failed_at}
+                for notification_id, failed_at in failed
+            ])
+            session.commit()
+        finally:
+            session.close()
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(1)
+            await self.flush()
@@ -0,0 +1,278 @@
+import re
+from bisect import bisect_left, bisect_right
+from collections import deque
+from datetime import datetime, timezone
+
+KEYWORD_SEPARATORS = re.compile(r'[,;\n]+')
+REGION_PATTERN = re.compile(r'^\d{1,2}$')
+
+
+def normalize_text(text: str) -> str:
+    """Lower-case text and fold ё into е so that keyword matching ignores both."""
+    return (text or '').lower().replace('ё', 'е')
+
+
+def parse_keywords(text: str):
+    """Split user input like 'ремонт, кровля' into normalized keywords without duplicates."""
+    keywords = []
+    for keyword in KEYWORD_SEPARATORS.split(normalize_text(text)):
+        keyword = ' '.join(keyword.split())
+        if keyword and keyword not in keywords:
+            keywords.append(keyword)
+    return keywords
+
+
+def _parse_amount(text: str) -> float:
+    amount = float(text.replace(',', '.'))
+    if amount < 0:
+        raise ValueError(f"Negative amount {text}")
+    return amount
+
+
+def parse_price_range(text: str):
+    """Parse '100000-500000', 'от 100000' or 'до 500000' into (min_price, max_price).
+
+    Either bound may be None. Raises ValueError for anything else.
+    """
+    text = normalize_text(text).replace(' ', '').replace('\xa0', '').replace('руб', '').rstrip('.')
+    if text.startswith('от'):
+        min_price, max_price = text[2:], ''
+        if 'до' in min_price:
+            min_price, max_price = min_price.split('до', 1)
+    elif text.startswith('до'):
+        min_price, max_price = '', text[2:]
+    elif '-' in text:
+        min_price, max_price = text.split('-', 1)
+    else:
+        min_price, max_price = text, ''
+    min_price = _parse_amount(min_price) if min_price else None
+    max_price = _parse_amount(max_price) if max_price else None
+    if min_price is None and max_price is None:
+        raise ValueError(f"No price in '{text}'")
+    if min_price is not None and max_price is not None and min_price > max_price:
+        raise ValueError(f"Empty price range '{text}'")
+    return min_price, max_price
+
+
+def parse_regions(text: str):
+    """Parse region codes like '77, 50' into two-digit strings. Raises ValueError on bad input."""
+    regions = []
+    for region in re.split(r'[\s,;]+', text.strip()):
+        if not region:
+            continue
+        if not REGION_PATTERN.match(region) or region in ('0', '00'):
+            raise ValueError(f"Invalid region '{region}'")
+        region = region.zfill(2)
+        if region not in regions:
+            regions.append(region)
+    if not regions:
+        raise ValueError("No regions given")
+    return regions
+
+
+def tender_region(tender: dict):
+    """Two-digit region code of a tender: its `region` field or the first digits of the customer's INN."""
+    return region_code(tender.get('region'), tender.get('customers'))
+
+
+def region_code(region, customers):
+    """Two-digit region code from a purchase's `region` and `customers` fields (see tender_region)."""
+    if region is not None:
+        digits = ''.join(ch for ch in str(region) if ch.isdigit())
+        if digits:
+            return digits.zfill(2) if len(digits) <= 2 else digits[:2]
+    customer = customers[0] if customers else None
+    if isinstance(customer, dict):
+        customer = customer.get('inn')
+    customer = str(customer or '')
+    # Legal entities have 10-digit and individuals 12-digit INNs; both start with the region code
+    if customer.isdigit() and len(customer) in (10, 12):
+        return customer[:2]
+    return None
+
+
+def tender_days_left(tender, now=None):
+    """Days left until applications close, or None if the tender has no deadline."""
+    finished_at = tender.collecting_finished_at
+    if finished_at is None:
+        return None
+    if finished_at.tzinfo is not None:
+        now = now or datetime.now(timezone.utc)
+        if now.tzinfo is None:
+            now = now.replace(tzinfo=timezone.utc)
+    else:
+        now = (now or datetime.utcnow()).replace(tzinfo=None)
+    return (finished_at - now).total_seconds() / 86400
+
+
+class SubscriptionFilter:
+    """Filters of a single subscription. Unknown tender values never pass a set filter."""
+
+    __slots__ = ('include', 'exclude', 'min_price', 'max_price', 'regions', 'min_days_left')
+
+    def __init__(self, include=(), exclude=(), min_price=None, max_price=None, regions=(), min_days_left=None):
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self.min_price = min_price
+        self.max_price = max_price
+        self.regions = frozenset(regions)
+        self.min_days_left = min_days_left
+
+    @classmethod
+    def from_columns(cls, include_keywords=None, exclude_keywords=None, min_price=None, max_price=None,
+                     regions=None, min_days_left=None):
+        """Build a filter from Subscription column values."""
+        return cls(
+            include=parse_keywords(include_keywords or ''),
+            exclude=parse_keywords(exclude_keywords or ''),
+            min_price=min_price,
+            max_price=max_price,
+            regions=[region.strip() for region in (regions or '').split(',') if region.strip()],
+            min_days_left=min_days_left
+        )
+
+    @property
+    def has_price(self):
+        return self.min_price is not None or self.max_price is not None
+
+    def __bool__(self):
+        return bool(self.include or self.exclude or self.has_price or self.regions or self.min_days_left)
+
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton finding which of many keywords occur in a text in one pass."""
+
+    def __init__(self, keywords):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+        for keyword in keywords:
+            self._add(keyword)
+        self._build()
+
+    def _add(self, keyword: str):
+        state = 0
+        for ch in keyword:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][ch] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            state = next_state
+        if keyword not in self._output[state]:
+            self._output[state] += (keyword,)
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(ch, 0)
+                self._output[next_state] += self._output[self._fail[next_state]]
+
+    def find(self, text: str) -> set:
+        """Return the keywords that occur in `text` as substrings."""
+        found = set()
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+class FilterIndex:
+    """Subscribers of one OKVED code with their filters compiled for matching.
+
+    A tender is matched against all subscribers at once: keywords through a
+    single Aho-Corasick pass over its name, prices and deadlines through
+    bisection of sorted bounds, regions through a dict lookup. Subscribers
+    without filters always match.
+    """
+
+    def __init__(self, filters):
+        """`filters` maps subscriber -> SubscriptionFilter (or None for no filter)."""
+        self._unfiltered = {subscriber for subscriber, f in filters.items() if not f}
+        filtered = {subscriber: f for subscriber, f in filters.items() if f}
+        self._filtered = frozenset(filtered)
+
+        self._include_by_keyword = {}
+        self._exclude_by_keyword = {}
+        self._include_free = set()
+        for subscriber, f in filtered.items():
+            if not f.include:
+                self._include_free.add(subscriber)
+            for keyword in f.include:
+                self._include_by_keyword.setdefault(keyword, set()).add(subscriber)
+            for keyword in f.exclude:
+                self._exclude_by_keyword.setdefault(keyword, set()).add(subscriber)
+        keywords = self._include_by_keyword.keys() | self._exclude_by_keyword.keys()
+        self._automaton = KeywordAutomaton(sorted(keywords)) if keywords else None
+
+        priced = [(subscriber, f) for subscriber, f in filtered.items() if f.has_price]
+        self._price_free = self._filtered - {subscriber for subscriber, _ in priced}
+        by_min = sorted((f.min_price if f.min_price is not None else float('-inf'), subscriber) for subscriber, f in priced)
+        by_max = sorted((f.max_price if f.max_price is not None else float('inf'), subscriber) for subscriber, f in priced)
+        self._min_prices = [price for price, _ in by_min]
+        self._min_subscribers = [subscriber for _, subscriber in by_min]
+        self._max_prices = [price for price, _ in by_max]
+        self._max_subscribers = [subscriber for _, subscriber in by_max]
+
+        self._by_region = {}
+        self._region_free = set()
+        for subscriber, f in filtered.items():
+            if not f.regions:
+                self._region_free.add(subscriber)
+            for region in f.regions:
+                self._by_region.setdefault(region, set()).add(subscriber)
+
+        by_days = sorted((f.min_days_left, subscriber) for subscriber, f in filtered.items() if f.min_days_left)
+        self._days_free = self._filtered - {subscriber for _, subscriber in by_days}
+        self._min_days = [days for days, _ in by_days]
+        self._days_subscribers = [subscriber for _, subscriber in by_days]
+
+    def match(self, tender) -> set:
+        """Return the subscribers whose filters accept `tender` (a ParsedTender)."""
+        if not self._filtered:
+            return set(self._unfiltered)
+        matched = set(self._filtered)
+
+        if self._automaton:
+            found = self._automaton.find(tender.search_text)
+            if self._include_by_keyword:
+                included = set(self._include_free)
+                for keyword in found:
+                    included.update(self._include_by_keyword.get(keyword, ()))
+                matched &= included
+            for keyword in found:
+                matched.difference_update(self._exclude_by_keyword.get(keyword, ()))
+
+        if matched and self._min_prices:
+            price = tender.amount
+            if price is None:
+                matched &= self._price_free
+            else:
+                above_min = self._min_subscribers[:bisect_right(self._min_prices, price)]
+                below_max = self._max_subscribers[bisect_left(self._max_prices, price):]
+                matched &= self._price_free | (set(above_min) & set(below_max))
+
+        if matched and self._by_region:
+            matched &= self._region_free | self._by_region.get(tender.region, set())
+
+        if matched and self._min_days:
+            days_left = tender_days_left(tender)
+            if days_left is None:
+                matched &= self._days_free
+            else:
+                matched &= self._days_free | set(self._days_subscribers[:bisect_right(self._min_days, days_left)])
+
+        return matched | self._unfiltered
@@ -0,0 +1,317 @@
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Union
+
+from sqlalchemy import insert
+
+import fast_json
+from metrics import TENDER_DETECTION_DELAY
+from subscription_filters import normalize_text, region_code
+from models import Session, Tender, Notification, PollCursor, PollBackfill
+
+logger = logging.getLogger(__name__)
+
+ZAKUPKI_URL = "https://zakupki.gov.ru/epz/order/notice/ea44/view/common-info.html?regNumber={}"
+
+
+def _parse_api_datetime(value):
+    """Parse an ISO date from the API keeping its time zone, or None if missing or malformed."""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _naive(value):
+    return value.replace(tzinfo=None) if value is not None else None
+
+
+class ParsedTender:
+    """A tender from the API, parsed once when it is fetched.
+
+    Dates keep the time zone the API gave them and are stored without it.
+    Only the fields the pipeline uses are kept, so the raw JSON dict can be
+    dropped right after parsing.
+    """
+
+    __slots__ = (
+        'purchase_number', 'name', 'search_text', 'amount', 'currency_code', 'customer', 'region', 'url',
+        'published_at', 'updated_at', 'collecting_finished_at'
+    )
+
+    def __init__(self, purchase_number, name=None, amount=None, currency_code=None, customer=None, region=None,
+                 published_at=None, updated_at=None, collecting_finished_at=None):
+        self.purchase_number = purchase_number
+        self.name = name
+        self.search_text = normalize_text(name)
+        self.amount = amount
+        self.currency_code = currency_code
+        self.customer = customer
+        self.region = region
+        self.url = ZAKUPKI_URL.format(purchase_number)
+        self.published_at = published_at
+        self.updated_at = updated_at
+        self.collecting_finished_at = collecting_finished_at
+
+    @classmethod
+    def from_api(cls, tender: dict):
+        """Build a record from a purchase dict of the GosPlan API."""
+        return cls.from_fields(
+            tender.get('purchase_number'), tender.get('object_info', 'Нет описания'), tender.get('max_price', 0),
+            tender.get('currency_code', 'RUB'), tender.get('customers'), tender.get('region'),
+            tender.get('published_at'), tender.get('updated_at'), tender.get('collecting_finished_at')
+        )
+
+    @classmethod
+    def from_fields(cls, purchase_number, object_info, max_price, currency_code, customers, region,
+                    published_at, updated_at, collecting_finished_at):
+        """Build a record from the raw values of a purchase's fields."""
+        try:
+            amount = float(max_price) if max_price is not None else None
+        except (TypeError, ValueError):
+            amount = None
+        return cls(
+            purchase_number=purchase_number,
+            name=object_info,
+            amount=amount,
+            currency_code=currency_code,
+            customer=(customers or ['Не указан'])[0],
+            region=region_code(region, customers),
+            published_at=_parse_api_datetime(published_at),
+            updated_at=_parse_api_datetime(updated_at),
+            collecting_finished_at=_parse_api_datetime(collecting_finished_at)
+        )
+
+    @property
+    def update_key(self):
+        """Position in the API's UPDATE_DATE ordering: (update date, purchase number).
+
+        None without an update date: the publication date says nothing about
+        where an amended tender sits in that ordering.
+        """
+        if self.updated_at is None:
+            return None
+        return (_naive(self.updated_at), self.purchase_number)
+
+    def publication_delay(self):
+        """Seconds since the tender was published, or None if its date has no time zone."""
+        if self.published_at is None or self.published_at.tzinfo is None:
+            return None
+        return (datetime.now(timezone.utc) - self.published_at).total_seconds()
+
+
+if fast_json.msgspec is not None:
+    class _ApiPurchase(fast_json.msgspec.Struct):
+        """Fields of a GosPlan purchase the pipeline uses; other fields are skipped while decoding.
+
+        Dates stay strings so that one malformed date drops only that date
+        (see _parse_api_datetime), not the whole page.
+        """
+
+        purchase_number: Optional[str] = None
+        object_info: Optional[str] = 'Нет описания'
+        max_price: Union[float, str, None] = 0
+        currency_code: Optional[str] = 'RUB'
+        customers: Optional[List[Union[str, Dict[str, Any]]]] = None
+        region: Union[int, str, None] = None
+        published_at: Optional[str] = None
+        updated_at: Optional[str] = None
+        collecting_finished_at: Optional[str] = None
+
+    _purchases_decoder = fast_json.msgspec.json.Decoder(List[_ApiPurchase])
+else:
+    _purchases_decoder = None
+
+
+def parse_purchases(body: bytes):
+    """Decode a page of the purchases API straight into ParsedTender records.
+
+    With msgspec installed the page is decoded and type-checked against a
+    schema of the used fields, so the rest of each purchase is never
+    materialized and no intermediate dicts are built.
+    """
+    if _purchases_decoder is not None:
+        return [
+            ParsedTender.from_fields(
+                purchase.purchase_number, purchase.object_info, purchase.max_price, purchase.currency_code,
+                purchase.customers, purchase.region, purchase.published_at, purchase.updated_at,
+                purchase.collecting_finished_at
+            )
+            for purchase in _purchases_decoder.decode(body)
+        ]
+    purchases = fast_json.loads(body)
+    if not isinstance(purchases, list):
+        raise ValueError(f"Expected a list of purchases, got {type(purchases).__name__}")
+    return [ParsedTender.from_api(purchase) for purchase in purchases]
+
+
+def load_cursors(session: Session, codes):
+    """Return (dict of code -> (last_update_date, last_purchase_number), dict of code -> last_success_at)."""
+    if not codes:
+        return {}, {}
+    cursors = {}
+    last_success = {}
+    for cursor in session.query(PollCursor).filter(PollCursor.code.in_(list(codes))):
+        cursors[cursor.code] = (cursor.last_update_date, cursor.last_purchase_number)
+        last_success[cursor.code] = cursor.last_success_at
+    return cursors, last_success
+
+
+def advance_cursors(session: Session, updates, polled=()):
+    """Move per-code cursors forward and mark `polled` codes as successfully polled now.
+
+    Changes are committed by the caller together with the notifications.
+    """
+    now = datetime.utcnow()
+    for code, (update_date, purchase_number) in updates.items():
+        session.merge(PollCursor(
+            code=code, last_update_date=update_date, last_purchase_number=purchase_number, last_success_at=now
+        ))
+    unchanged = [code for code in polled if code not in updates]
+    if unchanged:
+        session.query(PollCursor).filter(PollCursor.code.in_(unchanged)).update(
+            {'last_success_at': now}, synchronize_session=False
+        )
+
+
+def load_backfills(session: Session, codes):
+    """Return unfinished backfills of the given codes as (id, code, target key, next page) in creation order."""
+    if not codes:
+        return []
+    return [
+        (backfill.id, backfill.code, (backfill.target_update_date, backfill.target_purchase_number), backfill.next_page)
+        for backfill in session.query(PollBackfill).filter(
+            PollBackfill.code.in_(list(codes))
+        ).order_by(PollBackfill.id)
+    ]
+
+
+def checkpoint_backfills(session: Session, started=(), progress=None):
+    """Record new backfills and the progress of running ones; committed by the caller.
+
+    `started` holds (code, target key, first page) tuples; `progress` maps a
+    backfill id to its next page, or to None once it is finished.
+    """
+    for code, (update_date, purchase_number), next_page in started:
+        session.add(PollBackfill(
+            code=code, target_update_date=update_date, target_purchase_number=purchase_number, next_page=next_page
+        ))
+    for backfill_id, next_page in (progress or {}).items():
+        query = session.query(PollBackfill).filter(PollBackfill.id == backfill_id)
+        if next_page is None:
+            query.delete(synchronize_session=False)
+        else:
+            query.update({'next_page': next_page}, synchronize_session=False)
+
+
+class SeenSet:
+    """Bounded LRU set of (user_id, purchase_number) pairs that were already notified.
+
+    A hit means the pair is known to be notified; a miss only means it is not
+    cached and has to be confirmed against the database. Cycles and backfill
+    pages save from several database threads at once, so every operation
+    takes a lock.
+    """
+
+    def __init__(self, capacity: int = 100000):
+        self.capacity = capacity
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        with self._lock:
+            self._items[key] = None
+            self._items.move_to_end(key)
+            if len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return True
+            return False
+
+    def __len__(self):
+        return len(self._items)
+
+
+def warm_seen_set(seen: SeenSet):
+    """Fill the seen-set with the most recent notifications from the database."""
+    session = Session()
+    try:
+        rows = session.query(Notification.user_id, Notification.tender_number).order_by(
+            Notification.id.desc()
+        ).limit(seen.capacity).all()
+        # Insert oldest first so the newest pairs are the last to be evicted
+        for user_id, tender_number in reversed(rows):
+            seen.add((user_id, tender_number))
+        logger.info(f"Warmed seen-set with {len(rows)} notifications")
+    finally:
+        session.close()
+
+
+def store_tenders(session: Session, tenders):
+    """Store each tender (a ParsedTender) once in the shared tenders table.
+
+    Returns a dict of purchase_number -> Tender for all given tenders.
+    """
+    numbers = [tender.purchase_number for tender in tenders]
+    stored = {
+        tender.purchase_number: tender
+        for tender in session.query(Tender).filter(Tender.purchase_number.in_(numbers)).all()
+    } if numbers else {}
+
+    rows = {}
+    for tender in tenders:
+        number = tender.purchase_number
+        if number in stored or number in rows:
+            continue
+        rows[number] = {
+            'purchase_number': number,
+            'name': tender.name,
+            'amount': tender.amount,
+            'currency_code': tender.currency_code,
+            'customer': tender.customer,
+            'url': tender.url,
+            'published_at': _naive(tender.published_at),
+            'collecting_finished_at': _naive(tender.collecting_finished_at)
+        }
+        delay = tender.publication_delay()
+        if delay is not None:
+            TENDER_DETECTION_DELAY.observe(max(delay, 0.0))
+    if rows:
+        # One multi-row INSERT ... RETURNING per batch instead of a statement per tender
+        for row in session.scalars(insert(Tender).returning(Tender), list(rows.values())):
+            stored[row.purchase_number] = row
+    return stored
+
+
+def filter_unseen(session: Session, seen: SeenSet, pairs):
+    """Drop (user_id, purchase_number) pairs that were already notified.
+
+    Pairs found in the seen-set are rejected without touching the database;
+    the remaining ones are confirmed with a single query.
+    """
+    misses = [pair for pair in pairs if pair not in seen]
+    if not misses:
+        return []
+
+    user_ids = {user_id for user_id, _ in misses}
+    numbers = {number for _, number in misses}
+    notified = {tuple(row) for row in session.query(Notification.user_id, Notification.tender_number).filter(
+        Notification.user_id.in_(user_ids),
+        Notification.tender_number.in_(numbers)
+    )}
+
+    unseen = []
+    for pair in misses:
+        if pair in notified:
+            seen.add(pair)
+        else:
+            unseen.append(pair)
+    return unseen
@@ -0,0 +1,194 @@
+import asyncio
+import hmac
+import logging
+import os
+import secrets
+import signal
+import sys
+
+from aiohttp import web
+from dotenv import load_dotenv
+from telegram import Update
+from telegram.ext import Application, BaseUpdateProcessor
+
+from metrics import WEBHOOK_REQUESTS, metrics_handler
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+BOT_MODE = os.getenv('BOT_MODE', 'polling')  # polling or webhook
+BOT_CONCURRENT_UPDATES = int(os.getenv('BOT_CONCURRENT_UPDATES', 16))  # Updates of different chats processed in parallel
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # Public HTTPS URL Telegram posts updates to; empty skips registration
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # Checked against X-Telegram-Bot-Api-Secret-Token; random if empty
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))  # Parallel connections Telegram may open
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+# The conversation only reacts to messages and inline button presses
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Process updates of different chats in parallel and of one chat in order.
+
+    ConversationHandler keeps one state per chat and user and expects that
+    chat's updates one at a time, so updates sharing a chat wait for each
+    other while the rest of the chats are served concurrently.
+
+    The base class takes its concurrency slot before do_process_update, so
+    an update waiting for its chat would hold a slot; it is given an
+    unbounded limit and the slots are taken here, after the chat lock.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates must be a positive integer")
+        super().__init__(sys.maxsize)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        key = None
+        if isinstance(update, Update):
+            if update.effective_chat:
+                key = update.effective_chat.id
+            elif update.effective_user:
+                key = update.effective_user.id
+        if key is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        lock, waiters = self._locks.get(key, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[key] = (lock, waiters + 1)
+        try:
+            async with lock, self._slots:
+                await coroutine
+        finally:
+            lock, waiters = self._locks[key]
+            if waiters > 1:
+                self._locks[key] = (lock, waiters - 1)
+            else:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def webhook_secret() -> str:
+    """Secret token for the webhook; generated per run when none is configured."""
+    return WEBHOOK_SECRET or secrets.token_urlsafe(32)
+
+
+def create_webhook_app(application: Application, path: str, secret: str) -> web.Application:
+    """aiohttp app that feeds Telegram updates posted to `path` into the application.
+
+    Also serves /healthz and /metrics so that one port covers the whole bot.
+    """
+    expected_secret = secret.encode()
+
+    async def handle_update(request: web.Request) -> web.Response:
+        received_secret = request.headers.get(SECRET_HEADER, '').encode()
+        if not hmac.compare_digest(received_secret, expected_secret):
+            logger.warning(f"Rejected webhook request from {request.remote}: wrong secret token")
+            WEBHOOK_REQUESTS.labels('rejected').inc()
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            if not isinstance(data, dict):
+                raise ValueError(f"expected a JSON object, got {type(data).__name__}")
+            update = Update.de_json(data, application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Malformed webhook update: {e}")
+            WEBHOOK_REQUESTS.labels('malformed').inc()
+            return web.Response(status=400)
+        if update is None:
+            WEBHOOK_REQUESTS.labels('malformed').inc()
+            return web.Response(status=400)
+        # Answer Telegram right away; the update is handled by the application's own tasks
+        await application.update_queue.put(update)
+        WEBHOOK_REQUESTS.labels('accepted').inc()
+        return web.Response()
+
+    async def handle_health(request: web.Request) -> web.Response:
+        status = 'ok' if application.running else 'stopped'
+        return web.json_response(
+            {'status': status, 'pending_updates': application.update_queue.qsize()},
+            status=200 if application.running else 503
+        )
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    app.router.add_get('/healthz', handle_health)
+    app.router.add_get('/metrics', metrics_handler)
+    return app
+
+
+async def _serve_webhook(application: Application):
+    secret = webhook_secret()
+    runner = web.AppRunner(create_webhook_app(application, WEBHOOK_PATH, secret), access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        logger.info(f"Webhook server listening on http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL,
+                allowed_updates=ALLOWED_UPDATES,
+                secret_token=secret,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+            logger.info(f"Webhook registered at {WEBHOOK_URL}")
+        else:
+            # Useful for local testing with hand-made update POSTs signed with WEBHOOK_SECRET
+            logger.warning("WEBHOOK_URL is not set; the webhook is not registered with Telegram")
+
+        await application.start()
+
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stopped.set)
+            except NotImplementedError:
+                # Windows; Ctrl+C arrives as KeyboardInterrupt instead
+                pass
+        await stopped.wait()
+        logger.info("Stop signal received, shutting down")
+    finally:
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await runner.cleanup()
+
+
+async def _run_webhook(application: Application):
+    # Same lifecycle as Application.run_polling, with the aiohttp server in place of the updater
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await _serve_webhook(application)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run_webhook(application: Application):
+    """Serve updates from the embedded webhook server until SIGINT/SIGTERM."""
+    try:
+        asyncio.run(_run_webhook(application))
+    except KeyboardInterrupt:
+        pass
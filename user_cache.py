@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+from metrics import USER_CACHE_LOOKUPS
+
+load_dotenv()
+
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))  # Users whose state is kept in memory
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 300))  # Seconds before a cached user is reloaded from the database
+
+
+class UserState:
+    """What the conversation handlers need to know about a user."""
+
+    __slots__ = (
+        'user_id', 'codes', 'digest_mode', 'last_check', 'notifications_total', 'notifications_sent',
+        'last_sent_at', 'loaded_at'
+    )
+
+    def __init__(self, user_id: int, codes, digest_mode: bool, last_check=None,
+                 notifications_total: int = 0, notifications_sent: int = 0, last_sent_at=None):
+        self.user_id = user_id
+        self.codes = tuple(codes)
+        self.digest_mode = digest_mode
+        self.last_check = last_check
+        # Counters are only refreshed when the state is reloaded, i.e. at most every `ttl` seconds
+        self.notifications_total = notifications_total
+        self.notifications_sent = notifications_sent
+        self.last_sent_at = last_sent_at
+        self.loaded_at = time.monotonic()
+
+
+class UserCache:
+    """LRU cache of UserState by telegram_id whose entries expire after `ttl` seconds.
+
+    Shared by the database threads, so every operation takes a lock. Writers
+    put the state they committed (write-through); the poller and the sender
+    report new notifications so that the last check time stays current.
+    The TTL bounds staleness caused by other processes, e.g. a poller that
+    runs with --role=poller.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, telegram_id: int):
+        """Return the cached state, or None if it is missing or expired."""
+        with self._lock:
+            state = self._states.get(telegram_id)
+            if state is not None and time.monotonic() - state.loaded_at > self.ttl:
+                del self._states[telegram_id]
+                state = None
+            if state is None:
+                USER_CACHE_LOOKUPS.labels('miss').inc()
+                return None
+            self._states.move_to_end(telegram_id)
+        USER_CACHE_LOOKUPS.labels('hit').inc()
+        return state
+
+    def put(self, telegram_id: int, state: UserState):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._states[telegram_id] = state
+            self._states.move_to_end(telegram_id)
+            while len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+
+    def update(self, telegram_id: int, **values):
+        """Change fields of a cached state in place; does nothing if it isn't cached."""
+        with self._lock:
+            state = self._states.get(telegram_id)
+            if state is None:
+                return
+            for field, value in values.items():
+                setattr(state, field, tuple(value) if field == 'codes' else value)
+
+    def note_notifications(self, created_at_by_user):
+        """Move the last check time of cached users forward to their newest notification."""
+        with self._lock:
+            for telegram_id, created_at in created_at_by_user.items():
+                state = self._states.get(telegram_id)
+                if state is not None and created_at and (state.last_check is None or created_at > state.last_check):
+                    state.last_check = created_at
+
+    def invalidate(self, telegram_id: int = None):
+        """Forget one user, or everybody when no telegram_id is given."""
+        with self._lock:
+            if telegram_id is None:
+                self._states.clear()
+            else:
+                self._states.pop(telegram_id, None)
+
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)